@@ -1,5 +1,266 @@
 import numpy as np
-from scipy import optimize
+from scipy import optimize, sparse
+from scipy.sparse.linalg import svds
+
+from profiler import prof, profiled
+
+NNLS_ENGINES = ('fcnnls', 'scipy')
+SOLVERS = ('anls', 'hals', 'mu')
+INITS = ('random', 'nndsvd', 'nndsvda', 'residual')
+MARKER_SCORES = ('specificity', 'variance')
+ONLINE_DECAY = 10.0
+
+#############################################################
+#                                                           #
+#             Batched NNLS (FCNNLS)                         #
+#                                                           #
+#############################################################
+
+
+def _solve_passive(AtA, AtB, P, chunk=4096):
+    """
+    Solve the unconstrained normal equations of every column of AtB,
+    restricted to its passive set (True entries in P). Columns sharing
+    the same passive set are solved together with one factorization.
+    When most passive sets are distinct, solve a stack of systems
+    instead, masked to their passive sets.
+    """
+    if P.all():
+        return _solve(AtA, AtB)
+    nr_vars, nr_cols = AtB.shape
+    # group columns by passive set, using the packed bits as keys
+    bits = np.packbits(P, axis=0)
+    keys = np.ascontiguousarray(bits.T).view((np.void, bits.shape[0])).ravel()
+    _, first, groups = np.unique(keys, return_index=True, return_inverse=True)
+    if len(first) * nr_vars > nr_cols:
+        try:
+            return _solve_stacked(AtA, AtB, P, chunk)
+        except np.linalg.LinAlgError:
+            pass
+    K = np.zeros(AtB.shape)
+    groups = groups.ravel()
+    for g, col in enumerate(first):
+        rows = np.flatnonzero(P[:, col])
+        if not rows.size:
+            continue
+        cols = np.flatnonzero(groups == g)
+        K[np.ix_(rows, cols)] = _solve(AtA[np.ix_(rows, rows)],
+                                       AtB[np.ix_(rows, cols)])
+    return K
+
+
+def _solve_stacked(AtA, AtB, P, chunk):
+    K = np.empty(AtB.shape)
+    diag = np.arange(AtA.shape[0])
+    for s in range(0, AtB.shape[1], chunk):
+        p = P[:, s:s + chunk].T
+        # AtA masked to the passive set, and identity for active variables
+        G = np.where(p[:, :, None] & p[:, None, :], AtA, 0)
+        G[:, diag, diag] = np.where(p, AtA[diag, diag], 1)
+        B = np.where(p, AtB[:, s:s + chunk].T, 0)
+        K[:, s:s + chunk] = np.linalg.solve(G, B[..., None])[..., 0].T
+    return K
+
+
+def _solve(G, B):
+    try:
+        return np.linalg.solve(G, B)
+    except np.linalg.LinAlgError:
+        # singular Gram matrix (e.g. duplicated atlas columns)
+        return np.linalg.lstsq(G, B, rcond=None)[0]
+
+
+@profiled('fcnnls')
+def fcnnls(AtA, AtB, init=None, max_iter=None):
+    """
+    Fast combinatorial NNLS (Van Benthem & Keenan, 2004).
+    Solve argmin_Y ||AY-B|| s.t. Y >= 0 for all columns of B at once,
+    given only the Gram matrix AtA and the projection AtB.
+    :param AtA: Gram matrix, size (nr_ref_samp, nr_ref_samp)
+    :param AtB: size (nr_ref_samp, nr_samp)
+    :param init: warm start. A non negative solution of a similar problem
+                 (e.g. from the previous NMF iteration), size like Y.
+                 Its non zero entries are the initial passive set.
+    :param max_iter: max number of pivoting iterations. Default 3*nr_ref_samp
+    :return: Y, size (nr_ref_samp, nr_samp)
+    """
+    nr_vars = AtA.shape[0]
+    if max_iter is None:
+        max_iter = 3 * nr_vars
+    eps = np.finfo(float).eps
+    tol = 10 * eps * nr_vars * max(np.abs(AtA).max(), np.abs(AtB).max(), 1)
+
+    # initial feasible solution: the unconstrained one, clipped
+    K = _solve(AtA, AtB)
+    P = K > 0
+    clipped = ~P.all(axis=0)
+    if init is not None and clipped.any():
+        # where clipping is needed, the passive set of init is a better guess
+        P[:, clipped] = init[:, clipped] > 0
+        K[:, clipped] = _solve_passive(AtA, AtB[:, clipped], P[:, clipped])
+        clipped[clipped] = (P[:, clipped] & (K[:, clipped] <= 0)).any(axis=0)
+        P &= K > 0
+    K[~P] = 0
+    D = K.copy()
+    # columns that were clipped, or are not optimal (see the KKT check
+    # below). Add the most violating variable to the passive set of the latter
+    W = AtB - np.matmul(AtA, K)
+    W[P] = -np.inf
+    add = ~clipped & (W > tol).any(axis=0)
+    P[W[:, add].argmax(axis=0), add] = True
+    F = np.flatnonzero(clipped | add)
+
+    it = 0
+    while F.size and it < max_iter:
+        K[:, F] = _solve_passive(AtA, AtB[:, F], P[:, F])
+
+        # infeasible columns: step back towards the last feasible point
+        H = F[(K[:, F] < 0).any(axis=0)]
+        while H.size and it < max_iter:
+            it += 1
+            KH, DH = K[:, H], D[:, H]
+            neg = P[:, H] & (KH < 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                alpha = np.where(neg, DH / (DH - KH), np.inf)
+            min_idx = alpha.argmin(axis=0)
+            alpha = alpha[min_idx, np.arange(H.size)]
+            D[:, H] = DH - alpha * (DH - KH)
+            D[min_idx, H] = 0
+            P[min_idx, H] = False
+            K[:, H] = _solve_passive(AtA, AtB[:, H], P[:, H])
+            H = H[(K[:, H] < 0).any(axis=0)]
+
+        # optimality (KKT) check on the active variables
+        W = AtB[:, F] - AtA @ K[:, F]
+        W[P[:, F]] = -np.inf
+        opt = (W <= tol).all(axis=0)
+        W, F = W[:, ~opt], F[~opt]
+        if F.size:
+            P[W.argmax(axis=0), F] = True
+            D[:, F] = K[:, F]
+        it += 1
+
+    prof.count('fcnnls.iterations', it)
+    K[K < 0] = 0
+    return K
+
+#############################################################
+#                                                           #
+#             Inexact (iterative) NNLS updates              #
+#                                                           #
+#############################################################
+
+# Both methods decrease 1/2 y'Gy - h'y, s.t y >= 0, for every column of
+# H, starting from the current Y. G is the Gram matrix and H the
+# projected target, like the input of fcnnls.
+
+@profiled('hals_update')
+def hals_update(G, H, Y):
+    """ One sweep of HALS (coordinate descent) over the rows of Y """
+    Y = Y.copy()
+    for k in range(Y.shape[0]):
+        if G[k, k] <= 0:
+            continue
+        Y[k] = np.maximum(Y[k] + (H[k] - np.matmul(G[k], Y)) / G[k, k], 0)
+    return Y
+
+
+@profiled('mu_update')
+def mu_update(G, H, Y, eps=1e-16):
+    """
+    Lee-Seung multiplicative update. H may be negative (e.g. when the
+    contribution of fixed columns is subtracted), so the gradient is
+    split into its positive and negative parts.
+    """
+    num = np.maximum(H, 0)
+    den = np.matmul(G, Y) + np.maximum(-H, 0) + eps
+    return Y * num / den
+
+
+ITERATIVE_UPDATES = {'hals': hals_update, 'mu': mu_update}
+
+#############################################################
+#                                                           #
+#             Initialization (NNDSVD)                       #
+#                                                           #
+#############################################################
+
+def _top_svd(X, k):
+    """ the k leading singular triplets of X, in decreasing order """
+    if k < min(X.shape) - 1:
+        # a constant starting vector keeps ARPACK deterministic
+        U, S, Vt = svds(X, k, v0=np.ones(min(X.shape)))
+        order = np.argsort(S)[::-1]
+        return U[:, order], S[order], Vt[order]
+    U, S, Vt = np.linalg.svd(_dense(X), full_matrices=False)
+    return U[:, :k], S[:k], Vt[:k]
+
+
+def nndsvd(X, k):
+    """
+    Nonnegative double SVD (Boutsidis & Gallopoulos, 2008): a deterministic
+    initial W for X ~ WH, size (nr_feat, k), from the leading singular
+    vectors of X, each replaced by its dominant nonnegative part.
+    X may have negative values (e.g. a residual).
+    """
+    U, S, Vt = _top_svd(X, k)
+    W = np.zeros((X.shape[0], k))
+    for j in range(k):
+        u, v = U[:, j], Vt[j]
+        up, un = np.maximum(u, 0), np.maximum(-u, 0)
+        vp, vn = np.maximum(v, 0), np.maximum(-v, 0)
+        up_norm, vp_norm = np.linalg.norm(up), np.linalg.norm(vp)
+        un_norm, vn_norm = np.linalg.norm(un), np.linalg.norm(vn)
+        if up_norm * vp_norm >= un_norm * vn_norm:
+            u, sigma = up / max(up_norm, 1e-16), up_norm * vp_norm
+        else:
+            u, sigma = un / max(un_norm, 1e-16), un_norm * vn_norm
+        W[:, j] = np.sqrt(S[j] * sigma) * u
+    return W
+
+#############################################################
+#                                                           #
+#             Marker features                               #
+#                                                           #
+#############################################################
+
+def specificity(A):
+    """
+    How specific every feature (row) of A is to every column: the margin
+    by which the column is above all other columns (a uniquely high
+    feature), or below all of them (a uniquely low one).
+    :return: scores, size (nr_feat, nr_ref_samp)
+    """
+    A = _dense(A).astype(float, copy=False)
+    if A.shape[1] < 2:
+        return A.copy()
+    # the max (min) of the other columns is the row max (min), unless the
+    # column is the max (min) itself, in which case it is the second one
+    srt = np.sort(A, axis=1)
+    above = np.where(A == srt[:, -1:], srt[:, -2:-1], srt[:, -1:])
+    below = np.where(A == srt[:, :1], srt[:, 1:2], srt[:, :1])
+    return np.maximum(A - above, below - A)
+
+
+@profiled('select_markers')
+def select_markers(A, k, score='specificity'):
+    """
+    Select the features (rows) of the atlas that discriminate between its
+    columns, to deconvolve on them only.
+    :param A: reference atlas, size (nr_feat, nr_ref_samp)
+    :param k: number of features per column, int
+    :param score: one of MARKER_SCORES. specificity keeps the k most
+                  specific features of every column (see specificity).
+                  variance keeps the k * nr_ref_samp features of highest
+                  variance across the columns
+    :return: the sorted indices of the selected features
+    """
+    if score == 'variance':
+        var = _dense(A).astype(float, copy=False).var(axis=1)
+        top = np.argsort(-var, kind='stable')[:k * A.shape[1]]
+    else:
+        top = np.argsort(-specificity(A), axis=0, kind='stable')[:k]
+    return np.unique(top)
 
 #############################################################
 #                                                           #
@@ -8,35 +269,267 @@ from scipy import optimize
 #############################################################
 
 
+def _dense(M):
+    return M.toarray() if sparse.issparse(M) else np.asarray(M)
+
+
+def _single(M):
+    return not sparse.issparse(M) and M.dtype == np.float32
+
+
+def _dot(M, N):
+    """ M*N as a dense float64 array. M or N may be a scipy.sparse matrix """
+    if _single(M):
+        # compute in float32, rather than upcasting M (e.g. the data)
+        N = N.astype(np.float32, copy=False)
+    return _dense(M @ N).astype(float, copy=False)
+
+
+def _project(A, X, block=16384):
+    """ A'X as a dense array. A and X may be scipy.sparse matrices """
+    if sparse.issparse(X):
+        # X'A avoids converting the (large) X to another sparse format
+        return _dot(X.T, A).T
+    if _single(X) and not sparse.issparse(A):
+        # float32 products over blocks of features, summed in float64
+        A = A.astype(np.float32, copy=False)
+        res = np.zeros((A.shape[1], X.shape[1]))
+        for i in range(0, X.shape[0], block):
+            res += A[i:i + block].T @ X[i:i + block]
+        return res
+    return _dot(A.T, X)
+
+
+def _dot64(M, N, out=None, cells=2 ** 16):
+    """
+    M*N as a dense float64 array, accumulated in float64 also when M is
+    float32 (e.g. the data): M is cast a block of rows, of about cells
+    entries, at a time. Slower than _dot, but no sum is rounded to float32,
+    so the error computed from the statistics keeps its digits.
+    """
+    N = _dense(N).astype(float, copy=False)
+    if not _single(M):
+        if not sparse.issparse(M):
+            return np.matmul(M, N, out=out)
+        # scipy.sparse products are computed in the upcast type, float64
+        res = _dense(M @ N)
+        if out is None:
+            return res
+        out[:] = res
+        return out
+    res = np.empty((M.shape[0], N.shape[1])) if out is None else out
+    step = max(cells // max(M.shape[1], 1), 1)
+    for i in range(0, M.shape[0], step):
+        np.matmul(M[i:i + step].astype(float), N, out=res[i:i + step])
+    return res
+
+
+def _exact_project(A, X):
+    """ A'X like _project, but accumulated in float64 for float32 data """
+    return _dot64(X.T, A).T if X.dtype == np.float32 else _project(A, X)
+
+
+def _gram(A):
+    """ A'A, accumulated in float64 """
+    A = A.astype(float, copy=False)
+    return _project(A, A)
+
+
+def _sqnorm(X):
+    # accumulate in float64 (X may be float32)
+    x = X.data if sparse.issparse(X) else X.ravel(order='K')
+    return np.einsum('i,i->', x, x, dtype=float)
+
+
+def _float_dtype(X):
+    """ the precision to compute in: float32 for float32 data """
+    return np.result_type(X.dtype, np.float32)
+
+
+def _inner(M, N):
+    """ Frobenius inner product. M may be a scipy.sparse matrix """
+    if sparse.issparse(M):
+        return M.multiply(N).sum()
+    return np.sum(M * N)
+
+
 def calc_RMSE(A, Y, X):
-    return np.sqrt(np.power(np.matmul(A, Y) - X, 2).mean())
+    return np.sqrt(np.power(_dot(A, Y) - X, 2).mean())
+
+
+def calc_sq_error(A, AtA, XYt, YYt, sqnorm_X):
+    """
+    ||AY-X||^2, computed from the sufficient statistics AtA, XY', YY'
+    and ||X||^2, without materializing AY
+    """
+    return max(sqnorm_X - 2 * _inner(A, XYt) + np.sum(AtA * YYt), 0)
+
+
+def sample_sq_errors(A, X, Y):
+    """ ||Ay-x||^2 of every sample x (column of X), from A'A and A'X """
+    AtX = _exact_project(A, X)
+    if sparse.issparse(X):
+        sqnorm = np.asarray(X.multiply(X).sum(axis=0)).ravel()
+    else:
+        sqnorm = np.einsum('ij,ij->j', X, X, dtype=float)
+    AtAY = np.matmul(_gram(A), Y)
+    return np.maximum(sqnorm - 2 * np.einsum('ij,ij->j', AtX, Y) +
+                      np.einsum('ij,ij->j', AtAY, Y), 0)
+
+
+def rel_change(prev, cur):
+    return abs(prev - cur) / max(abs(prev), np.finfo(float).tiny)
+
+
+def converged(prev, cur, tol, patience, stalled):
+    """
+    Count the consecutive iterations whose relative change of the
+    objective (from prev to cur) is smaller than tol
+    :return: whether it stalled for patience iterations, and the count
+    """
+    if prev is not None and rel_change(prev, cur) < tol:
+        stalled += 1
+        return stalled >= patience, stalled
+    return False, 0
+
+
+def update_columns(Ao, Af, YYt, XYo, eta, solver='anls', solve=fcnnls,
+                   init=None, out=None):
+    """
+    The A-step of the NMF, from the statistics YY' and XYo' alone:
+        argmin_Ao ||Af*Yf + Ao*Yo - X||^2 + eta*||Ao||^2 s.t. Ao >= 0
+    for all features at once. Ao is updated in place.
+    :param Ao: the learned columns, size (nr_feat, nr_opt)
+    :param Af: the fixed columns, size (nr_feat, nr_fixed)
+    :param YYt: Y*Y', size (nr_ref_samp, nr_ref_samp), fixed columns first
+    :param XYo: X*Yo', size (nr_feat, nr_opt)
+    :param solver: one of SOLVERS. anls solves the step exactly with solve
+                   (fcnnls, or NNLSPool.fcnnls), from init
+    :param out: a buffer for the projected residual, size (nr_opt, nr_feat)
+    """
+    nr_fixed = Af.shape[1]
+    Gram = YYt[nr_fixed:, nr_fixed:] + eta * np.eye(Ao.shape[1])
+    # the projected residual Yo*(X - Af*Yf)', computed without forming it
+    YRt = np.matmul(YYt[nr_fixed:, :nr_fixed].astype(Ao.dtype), Af.T, out=out)
+    np.subtract(XYo.T, YRt, out=YRt)
+    if solver == 'anls':
+        Ao[:] = solve(Gram, YRt, init).T
+    else:
+        Ao[:] = ITERATIVE_UPDATES[solver](Gram, YRt, Ao.T).T
+
 
+def update_gram(AtA, A, nr_fixed):
+    """ refresh the blocks of A'A of the columns of A after nr_fixed """
+    AtA[nr_fixed:] = _exact_project(A[:, nr_fixed:], A)
+    AtA[:, nr_fixed:] = AtA[nr_fixed:].T
 
-def run_nnls(A, X, beta, normalize=True):
+
+def error_objective(sqnorm_X, AfXYf, Ao, XYo, AtA, YYt, beta, eta):
+    """
+    ||AY-X||^2 from the statistics, and the objective: the squared error
+    plus the beta and eta penalties. <A, XY'> is split into the fixed
+    block, AfXYf = <Af'X, Yf>, and the learned one, <Ao, XYo'>
+    :return: the squared error and the objective
+    """
+    AXYt = AfXYf + np.einsum('ij,ij->', Ao, XYo, dtype=float)
+    sq_error = max(sqnorm_X - 2 * AXYt + np.einsum('ij,ij->', AtA, YYt), 0)
+    # ||Y||_1^2 summed over the samples is the sum of YY'
+    obj = sq_error + beta * YYt.sum() + \
+        eta * np.einsum('ij,ij->', Ao, Ao, dtype=float)
+    return sq_error, obj
+
+
+@profiled('nnls_columns')
+def nnls_columns(M, B):
+    """
+    argmin_y ||My-b|| s.t. y >= 0, for every column b of B.
+    B may have fewer rows than M, in which case the missing (last) rows
+    are zeros. This saves stacking zeros to B for regularization rows
+    """
+    Y = np.empty((M.shape[1], B.shape[1]))
+    b = np.zeros(M.shape[0])
+    for i in range(B.shape[1]):
+        b[:B.shape[0]] = B[:, i]
+        Y[:, i], residual = optimize.nnls(M, b)
+    return Y
+
+
+@profiled('run_nnls')
+def run_nnls(A, X, beta, normalize=True, engine='fcnnls', pool=None,
+             init=None):
+    """
+    argmin_Y ||AY-X||^2 + beta*||Y||_1^2 s.t. Y >= 0
+    init is a warm start for Y (used by the fcnnls engine only)
+    """
     nr_samples = X.shape[1]
     nr_ref_samp = A.shape[1]
 
-    # init Y to nan
-    Y = np.empty((nr_ref_samp, nr_samples))
-    Y[:] = np.nan
-
-    # append sqrt(beta) row to A:
-    Ar = np.vstack([A, np.repeat(np.sqrt(beta), nr_ref_samp)])
-    # append zero row to A: 
-    Xr = np.vstack([X, np.repeat(0, nr_samples)])
+    if engine == 'fcnnls':
+        # The sqrt(beta) row appended to A adds beta to every entry of
+        # the Gram matrix. The zero row appended to X adds nothing.
+        solve = fcnnls if pool is None else pool.fcnnls
+        Y = solve(_gram(A) + beta, _project(A, X), init)
+    else:
+        A, X = _dense(A), _dense(X)
+        # append sqrt(beta) row to A (and implicitly, a zero row to X)
+        Ar = np.vstack([A, np.repeat(np.sqrt(beta), nr_ref_samp)])
 
-    # argmin_Y ||AY-X||
-    for i in range(nr_samples):
-        mixture, residual = optimize.nnls(Ar, Xr[:, i])
-        Y[:, i] = mixture
+        # argmin_Y ||AY-X||
+        solve = nnls_columns if pool is None else pool.nnls_columns
+        Y = solve(Ar, X)
     # normalize coefficients to sum to 1
     if normalize:
         Y = Y / Y.sum(axis=0)
 
-    return Y
+    return Y.astype(_float_dtype(X), copy=False)
+
+
+@profiled('run_nnls_stream')
+def run_nnls_stream(blocks, beta, normalize=True, norm_cols=False,
+                    pool=None):
+    """
+    NNLS (all atlas columns fixed) over a data table streamed in blocks
+    of rows (features). Only the sufficient statistics A'A, A'X and
+    ||X||^2 are kept, so memory does not grow with the number of features.
+    :param blocks: iterable of (A_block, X_block) pairs - the rows of the
+                   atlas and the data for the same features
+    :param beta: regularization parameter, float
+    :param normalize: Should Y be normalized to sum up to one.
+    :param norm_cols: normalize each data sample (column of X) to sum up
+                      to one, like load_table(norm_cols=True)
+    :param pool: a parallel.NNLSPool to solve on. Default is serial
+    :return: the mixture coefficients, and the RMSE
+    """
+    AtA = AtX = None
+    nr_features = 0
+    for A_b, X_b in blocks:
+        if AtA is None:
+            AtA = np.zeros((A_b.shape[1], A_b.shape[1]))
+            AtX = np.zeros((A_b.shape[1], X_b.shape[1]))
+            sqnorm_X = np.zeros(X_b.shape[1])
+            colsum_X = np.zeros(X_b.shape[1])
+        AtA += np.matmul(A_b.T, A_b)
+        AtX += np.matmul(A_b.T, X_b)
+        sqnorm_X += np.sum(X_b * X_b, axis=0)
+        colsum_X += X_b.sum(axis=0)
+        nr_features += X_b.shape[0]
+    if norm_cols:
+        AtX /= colsum_X
+        sqnorm_X /= colsum_X ** 2
+
+    solve = fcnnls if pool is None else pool.fcnnls
+    Y = solve(AtA + beta, AtX)
+    if normalize:
+        Y = Y / Y.sum(axis=0)
+    sq_error = max(sqnorm_X.sum() - 2 * np.sum(Y * AtX) +
+                   np.sum(AtA * np.matmul(Y, Y.T)), 0)
+    return Y, np.sqrt(sq_error / (nr_features * AtX.shape[1]))
 
 
-def run_deconvolution(A, X, fixed, beta, eta, n_iter, normalize):
+def run_deconvolution(A, X, fixed, beta, eta, n_iter, normalize,
+                      engine='fcnnls', pool=None, solver='anls',
+                      tol=0.0, patience=1, warm_start=False, callback=None,
+                      checkpoint=None, checkpoint_every=1, resume=None):
     """
     Run NMF
     :param A: reference atlas, size (nr_feat, nr_ref_samp)
@@ -46,38 +539,347 @@ def run_deconvolution(A, X, fixed, beta, eta, n_iter, normalize):
     :param eta: regularization parameter, float
     :param n_iter: number of iterations, int
     :param normalize: Should the NNLS step normalize Y to sum up to one.
-    :return: the mixture coefficients
+    :param engine: NNLS engine, one of NNLS_ENGINES
+    :param pool: a parallel.NNLSPool to solve on. Default is serial
+    :param solver: one of SOLVERS. anls solves each step exactly (NNLS).
+                   hals and mu perform a single cheap update per step.
+    :param tol: stop when the relative change of the objective is smaller
+                than tol for patience consecutive iterations. 0 never stops
+    :param patience: see tol, int
+    :param warm_start: start each exact (anls with fcnnls) step from the
+                       solution of the previous iteration.
+    :param callback: called as callback(it, obj) after each iteration, with
+                     the objective value. Stop if it returns True.
+    :param checkpoint: called as checkpoint(state) every checkpoint_every
+                       iterations (but the last), with the solver state: a
+                       dict of arrays and numbers
+    :param checkpoint_every: see checkpoint, int
+    :param resume: a state passed to checkpoint. Continue from it, exactly
+                   as the run that saved it did
+    :return: the atlas, the mixture coefficients and the RMSE per iteration
     """
     nr_ref_samp = A.shape[1]
-    nr_features = X.shape[0]
+    nr_features, nr_samples = X.shape
+    # A and Y are held in the precision of X. The products with X are
+    # computed in that precision, the rest in float64. But the statistics
+    # of the error, XY' and Af'X, are accumulated in float64 (see _dot64):
+    # ||X||^2 - 2<A, XY'> + <A'A, YY'> cancels the digits of the error
+    dtype = _float_dtype(X)
+    if sparse.issparse(A) and not fixed.all():
+        # the learned columns are dense
+        A = A.toarray()
+    A = A.astype(dtype, copy=False)
+    if engine == 'scipy':
+        # per column NNLS works on dense matrices
+        X = _dense(X)
+    sqnorm_X = _sqnorm(X)
+
+    def rmse(sq_error):
+        return np.sqrt(sq_error / (nr_features * nr_samples))
 
     history = []
     if fixed.sum() == len(fixed):
         # All columns are fixed. no NMF performed, only NNLS
-        Y = run_nnls(A, X, beta, normalize)
-        history.append(calc_RMSE(A, Y, X))
+        Y = run_nnls(A, X, beta, normalize, engine, pool)
+        sq_error = calc_sq_error(A, _gram(A), _dot64(X, Y.T),
+                                 np.matmul(Y, Y.T, dtype=float), sqnorm_X)
+        history.append(rmse(sq_error))
         return A, Y, history
 
-    # Otherwise, at least some of the columns are not fixed
-    fixed_inds = np.argwhere(fixed).flatten()
-    o_inds = np.argwhere(1 - fixed).flatten()
+    # Otherwise, at least some of the columns are not fixed.
+    # The columns are ordered fixed first, so the fixed (Af) and optimized
+    # (Ao) blocks of A are views. Af never changes, so its blocks of A'X
+    # and A'A are computed once. Every iteration updates only the blocks
+    # of Ao, in buffers allocated once for the whole run.
+    order = np.argsort(fixed == 0, kind='stable')
+    nr_fixed = int(np.sum(fixed != 0))
+    nr_opt = nr_ref_samp - nr_fixed
+    A = A[:, order]
+    if resume is not None:
+        A[:] = resume['A'][:, order]
+    Af, Ao = A[:, :nr_fixed], A[:, nr_fixed:]
+    AtX = np.empty((nr_ref_samp, nr_samples))
+    AtX[:nr_fixed] = _exact_project(Af, X)
+    AtA = _gram(A)
+    XYo = np.empty((nr_features, nr_opt))  # X*Yo'
+    YRt = np.empty((nr_opt, nr_features), dtype=dtype)  # Yo*(X - Af*Yf)'
+    scipy_engine = solver == 'anls' and engine == 'scipy'
+    if scipy_engine:
+        # [A; sqrt(beta)] for the Y-step
+        Ar = np.empty((nr_features + 1, nr_ref_samp))
+        Ar[:-1] = A
+        Ar[-1] = np.sqrt(beta)
+        # [Yo'; sqrt(eta)*I] and X - Af*Yf for the A-step
+        Yr = np.zeros((nr_samples + nr_opt, nr_opt))
+        Yr[nr_samples:] = np.sqrt(eta) * np.eye(nr_opt)
+        resid = np.empty((nr_features, nr_samples), dtype=dtype)
+    if solver != 'anls':
+        update = ITERATIVE_UPDATES[solver]
+        Y = np.full((nr_ref_samp, nr_samples), 1 / nr_ref_samp, dtype=dtype)
+    Y0 = None
+    prev_obj, stalled = None, 0
+    first = 0
+    if resume is not None:
+        # the Gram matrix is restored rather than recomputed: its blocks
+        # were updated separately, and may differ in the last bits
+        Y = resume['Y'][order]
+        AtA = resume['AtA'][np.ix_(order, order)]
+        history = list(resume['history'])
+        prev_obj, stalled = resume['prev_obj'], resume['stalled']
+        first = resume['it'] + 1
+        if warm_start and solver == 'anls':
+            Y0 = Y
 
-    for it in range(n_iter):
+    for it in range(first, n_iter):
+        prof.start_iteration()
         # argmin_Y ||A*Y-X||
-        Y = run_nnls(A, X, beta, normalize)
+        if scipy_engine:
+            Ar[:-1, nr_fixed:] = Ao
+            solve = nnls_columns if pool is None else pool.nnls_columns
+            Y = solve(Ar, X)
+        else:
+            AtX[nr_fixed:] = _project(Ao, X)
+            if solver == 'anls':
+                solve = fcnnls if pool is None else pool.fcnnls
+                Y = solve(AtA + beta, AtX, Y0)
+            else:
+                Y = update(AtA + beta, AtX, Y)
+        if normalize:
+            Y /= Y.sum(axis=0)
+        Y = Y.astype(dtype, copy=False)
+        if warm_start and solver == 'anls':
+            Y0 = Y
+        Yf, Yo = Y[:nr_fixed], Y[nr_fixed:]
+        prof.lap('y_step')
 
-        resid = X - np.matmul(A[:, fixed_inds], Y[fixed_inds, :])
-
-        # regularized A by sqrt(eta)
-        Xr = np.vstack([resid.T, np.zeros((nr_ref_samp, nr_features))])
-        Yr = np.vstack([Y.T, np.sqrt(eta) * np.eye(nr_ref_samp)])
+        # sufficient statistics for the A-step and the objective
+        _dot64(X, Yo.T, out=XYo)
+        YYt = np.matmul(Y, Y.T, dtype=float)
+        prof.lap('statistics')
 
         # argmin_A' ||Y'A'-X'||
-        for j in range(nr_features):
-            mixture, residual = optimize.nnls(Yr[:, o_inds], Xr[:, j])
-            A[j, o_inds] = mixture
-
-        # renormalize columns in A with max>1
-        # A = A / np.where(A.max(axis=0) > 1, A.max(axis=0), 1)
-        history.append(calc_RMSE(A, Y, X))
-    return A, Y, history
+        if scipy_engine:
+            np.matmul(Af, Yf, out=resid)
+            np.subtract(X, resid, out=resid)
+            Yr[:nr_samples] = Yo.T
+            solve = nnls_columns if pool is None else pool.nnls_columns
+            Ao[:] = solve(Yr, resid.T).T
+        else:
+            update_columns(Ao, Af, YYt, XYo, eta, solver,
+                           solve = fcnnls if pool is None else pool.fcnnls,
+                           init  = Ao.T if warm_start and it else None,
+                           out   = YRt)
+        prof.lap('a_step')
+
+        update_gram(AtA, A, nr_fixed)
+        sq_error, obj = error_objective(
+            sqnorm_X, np.einsum('ij,ij->', AtX[:nr_fixed], Yf, dtype=float),
+            Ao, XYo, AtA, YYt, beta, eta)
+        history.append(rmse(sq_error))
+        prof.lap('error')
+        prof.end_iteration(objective=obj, rmse=history[-1])
+        if callback is not None and callback(it, obj):
+            break
+        done, stalled = converged(prev_obj, obj, tol, patience, stalled)
+        if done:
+            break
+        prev_obj = obj
+        if checkpoint is not None and (it + 1) % checkpoint_every == 0 \
+                and it + 1 < n_iter:
+            inv = np.argsort(order)
+            checkpoint({'it': it, 'A': A[:, inv], 'Y': Y[inv],
+                        'AtA': AtA[np.ix_(inv, inv)], 'history': history,
+                        'prev_obj': prev_obj, 'stalled': stalled})
+
+    # restore the original order of the columns
+    inv = np.argsort(order)
+    return A[:, inv], Y[inv], history
+
+
+def refit_columns(A, X, Y, fixed, eta=0.0, pool=None):
+    """
+    Fit the non-fixed columns of A to the data given the coefficients, as
+    in the A-step of run_deconvolution:
+        argmin_Ao ||Af*Yf + Ao*Yo - X||^2 + eta*||Ao||^2 s.t. Ao >= 0
+    E.g. to extend columns learned on some of the features to all of them.
+    :param A: atlas, size (nr_feat, nr_ref_samp). Its fixed columns are kept
+    :param X: Data samples, size (nr_feat, nr_samp)
+    :param Y: mixture coefficients, size (nr_ref_samp, nr_samp)
+    :param fixed: which columns of A are fixed, size (nr_ref_samp, )
+    :return: the atlas, with the non-fixed columns refitted (dense)
+    """
+    opt = fixed == 0
+    if not opt.any():
+        return A
+    Y = Y.astype(float, copy=False)
+    YYt = np.matmul(Y, Y.T)
+    Gram = YYt[np.ix_(opt, opt)] + eta * np.eye(opt.sum())
+    # Yo*(X - Af*Yf)'
+    YRt = _dot(X, Y[opt].T).T - _dot(A[:, ~opt], YYt[np.ix_(~opt, opt)]).T
+    solve = fcnnls if pool is None else pool.fcnnls
+    A = _dense(A).astype(_float_dtype(X))
+    A[:, opt] = solve(Gram, YRt).T
+    return A
+
+
+@profiled('group_statistics')
+def group_statistics(A, X, nr_groups, seed=None):
+    """
+    Partition the features randomly into nr_groups groups of (almost)
+    equal size, and compute A'A and A'X of each group. The statistics of
+    any resampling of the groups are then sums of these.
+    :return: A'A per group, size (nr_groups, nr_ref_samp, nr_ref_samp),
+             and A'X per group, size (nr_groups, nr_ref_samp, nr_samp)
+    """
+    nr_features, nr_ref_samp = A.shape
+    nr_groups = min(nr_groups, nr_features)
+    A = _dense(A).astype(float, copy=False)
+    if sparse.issparse(X):
+        # for row indexing
+        X = X.tocsr()
+    perm = np.random.default_rng(seed).permutation(nr_features)
+    bounds = np.linspace(0, nr_features, nr_groups + 1).astype(int)
+    AtA = np.empty((nr_groups, nr_ref_samp, nr_ref_samp))
+    AtX = np.empty((nr_groups, nr_ref_samp, X.shape[1]))
+    for g in range(nr_groups):
+        idx = np.sort(perm[bounds[g]:bounds[g + 1]])
+        AtA[g] = np.matmul(A[idx].T, A[idx])
+        AtX[g] = _project(A[idx], X[idx])
+    return AtA, AtX
+
+
+@profiled('bootstrap_nnls')
+def bootstrap_nnls(AtA, AtX, counts, beta, normalize=True):
+    """
+    NNLS of the data on a fixed atlas, for bootstrap replicates of groups
+    of features (see group_statistics). A replicate is given by the number
+    of times each group was drawn, so its Gram matrices are weighted sums
+    of those of the groups, computed for all replicates by two products.
+    :param AtA: A'A per group, size (nr_groups, nr_ref_samp, nr_ref_samp)
+    :param AtX: A'X per group, size (nr_groups, nr_ref_samp, nr_samp)
+    :param counts: group counts per replicate, size (nr_rep, nr_groups)
+    :param beta: regularization parameter, float
+    :param normalize: Should Y be normalized to sum up to one.
+    :return: the mixture coefficients, size (nr_rep, nr_ref_samp, nr_samp)
+    """
+    nr_groups, nr_ref_samp, nr_samples = AtX.shape
+    nr_rep = counts.shape[0]
+    counts = counts.astype(float)
+    AtWA = (counts @ AtA.reshape(nr_groups, -1)).reshape(nr_rep, nr_ref_samp, -1)
+    AtWX = (counts @ AtX.reshape(nr_groups, -1)).reshape(nr_rep, nr_ref_samp, -1)
+    Y = np.empty((nr_rep, nr_ref_samp, nr_samples))
+    for r in range(nr_rep):
+        Y[r] = fcnnls(AtWA[r] + beta, AtWX[r])
+        if normalize:
+            Y[r] /= Y[r].sum(axis=0)
+    return Y
+
+
+@profiled('run_online')
+def run_online(A, X, fixed, beta, eta, n_iter, normalize, batch_size,
+               decay=ONLINE_DECAY, pool=None, solver='anls', tol=0.0,
+               patience=1):
+    """
+    Online (mini-batch) NMF, for data with too many samples to factorize
+    at once. Each epoch visits the samples in batches of batch_size columns,
+    in a random order. The coefficients of a batch are solved (fcnnls)
+    against the current atlas, its statistics YY' and XYo' are added to the
+    running ones, and the non-fixed columns of A are updated from the
+    running statistics. At the t-th batch, the previous batches are weighted
+    down by (1 - 1/t) ** decay (Mairal et al., 2010). The statistics are
+    kept as weighted means scaled to nr_samples, so beta and eta have the
+    same meaning as in run_deconvolution.
+    Only one batch of X is read at a time, so if X is memory-mapped (see
+    TableCache), memory does not grow with the number of samples, except
+    for the returned coefficients. After the last epoch, the coefficients
+    of all samples are solved against the final atlas.
+    :param A: reference atlas, size (nr_feat, nr_ref_samp)
+    :param X: Data samples, size (nr_feat, nr_samp)
+    :param fixed: which columns of A are fixed, size (nr_ref_samp, )
+    :param beta: regularization parameter, float
+    :param eta: regularization parameter, float
+    :param n_iter: number of epochs, int
+    :param normalize: Should the NNLS step normalize Y to sum up to one.
+    :param batch_size: number of samples per batch, int
+    :param decay: forgetting of the statistics of previous batches, float.
+                  0 weights all batches equally
+    :param pool: a parallel.NNLSPool to solve on. Default is serial
+    :param solver: one of SOLVERS, for the atlas update
+    :param tol: stop when the relative change of the error of an epoch is
+                smaller than tol for patience consecutive epochs
+    :param patience: see tol, int
+    :return: the atlas, the mixture coefficients and the RMSE per epoch
+             (each batch against the atlas at its time). The last one is
+             the RMSE of the final pass
+    """
+    nr_ref_samp = A.shape[1]
+    nr_features, nr_samples = X.shape
+    dtype = _float_dtype(X)
+    if sparse.issparse(A) and not fixed.all():
+        A = A.toarray()
+    A = A.astype(dtype, copy=False)
+    # fixed columns first, as in run_deconvolution
+    order = np.argsort(fixed == 0, kind='stable')
+    nr_fixed = int(np.sum(fixed != 0))
+    nr_opt = nr_ref_samp - nr_fixed
+    A = A[:, order]
+    Af, Ao = A[:, :nr_fixed], A[:, nr_fixed:]
+    AtA = _gram(A)
+    YYt = np.zeros((nr_ref_samp, nr_ref_samp))
+    XYo = np.zeros((nr_features, nr_opt))
+    solve = fcnnls if pool is None else pool.fcnnls
+    starts = np.arange(0, nr_samples, batch_size)
+
+    def batch(s):
+        X_b = X[:, s:s + batch_size]
+        X_b = X_b if sparse.issparse(X_b) else np.asarray(X_b)
+        AtX = _exact_project(A, X_b)
+        Y_b = solve(AtA + beta, AtX)
+        if normalize:
+            Y_b /= Y_b.sum(axis=0)
+        YYt_b = np.matmul(Y_b, Y_b.T)
+        sq_error = _sqnorm(X_b) - 2 * np.einsum('ij,ij->', AtX, Y_b) + \
+            np.einsum('ij,ij->', AtA, YYt_b)
+        return X_b, Y_b, YYt_b, max(sq_error, 0)
+
+    def rmse(sq_error):
+        return np.sqrt(sq_error / (nr_features * nr_samples))
+
+    history = []
+    prev_err, stalled = None, 0
+    weight, t = 0.0, 0
+    for it in range(n_iter if nr_opt else 0):
+        prof.start_iteration()
+        epoch_error = 0.0
+        for s in np.random.permutation(starts):
+            X_b, Y_b, YYt_b, sq_error = batch(s)
+            epoch_error += sq_error
+            t += 1
+            weight = (1 - 1 / t) ** decay * weight + X_b.shape[1]
+            keep = 1 - X_b.shape[1] / weight
+            YYt *= keep
+            YYt += YYt_b / weight
+            XYo *= keep
+            XYo += _dot64(X_b, Y_b[nr_fixed:].T) / weight
+
+            # argmin_A' ||Y'A'-X'|| over the samples seen so far
+            update_columns(Ao, Af, nr_samples * YYt, nr_samples * XYo, eta,
+                           solver, solve, init=Ao.T)
+            update_gram(AtA, A, nr_fixed)
+        history.append(rmse(epoch_error))
+        prof.end_iteration(rmse=history[-1])
+        done, stalled = converged(prev_err, epoch_error, tol, patience, stalled)
+        if done:
+            break
+        prev_err = epoch_error
+
+    # final pass: the coefficients of all samples against the final atlas
+    Y = np.empty((nr_ref_samp, nr_samples), dtype=dtype)
+    sq_error = 0.0
+    for s in starts:
+        _, Y[:, s:s + batch_size], _, batch_error = batch(s)
+        sq_error += batch_error
+    history[-1:] = [rmse(sq_error)]
+
+    inv = np.argsort(order)
+    return A[:, inv], Y[inv], history
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import os.path as op
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from algorithm import run_nnls, run_deconvolution, SOLVERS, NNLS_ENGINES
+from utils_nmf import eprint, load_table, table_values, save_npz_table, \
+    dpath, DTYPES
+
+MODES = ('nnls', 'nmf', 'optimize', 'add')
+
+#############################################################
+#                                                           #
+#             Synthetic data                                #
+#                                                           #
+#############################################################
+
+
+def gen_data(features, samples, refs, sparsity=0.0, noise=0.01, seed=1):
+    """
+    Generate a methylation-like atlas (values in [0, 1], a fraction
+    sparsity of them zero), true mixture coefficients (each sample sums up
+    to one) and noisy mixtures.
+    :return: atlas, data and true coefficients DataFrames
+    """
+    rng = np.random.default_rng(seed)
+    A = rng.beta(.5, .5, size=(features, refs))
+    A[rng.random(A.shape) < sparsity] = 0
+    Y = rng.dirichlet(np.ones(refs), size=samples).T
+    X = np.clip(A @ Y + rng.normal(scale=noise, size=(features, samples)), 0, 1)
+
+    index = pd.Index([f'f{i}' for i in range(features)], name='feature')
+    cols = [f'Ref.{i + 1}' for i in range(refs)]
+    snames = [f'Mix.{i + 1}' for i in range(samples)]
+    return pd.DataFrame(A, index=index, columns=cols), \
+        pd.DataFrame(X, index=index, columns=snames), \
+        pd.DataFrame(Y, index=cols, columns=snames)
+
+
+def match_columns(A_true, A):
+    """ order of the columns of A best matching the columns of A_true """
+    corr = np.corrcoef(A_true.T, A.T)[:A_true.shape[1], A_true.shape[1]:]
+    return linear_sum_assignment(-np.nan_to_num(corr))[1]
+
+#############################################################
+#                                                           #
+#             Measurements                                  #
+#                                                           #
+#############################################################
+
+
+def measure(func, repeat, memory=True):
+    """
+    Run func repeat times, and once more to trace its memory (tracing
+    slows down allocations, so the timed runs are not traced).
+    :return: its last result, the best time (sec) and the peak memory
+             allocated during a run (MB), or None if not memory
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func()
+        best = min(best, time.perf_counter() - start)
+    if not memory:
+        return res, best, None
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return res, best, peak
+
+
+def mode_setup(mode, atlas, rng):
+    """
+    Initial atlas and fixed columns of a README scenario:
+        nnls:     all columns fixed
+        nmf:      all columns learned from scratch
+        optimize: the first column is perturbed and optimized
+        add:      the last column is removed, and learned as a new one
+    """
+    A = atlas.values.copy()
+    fixed = np.ones(A.shape[1])
+    if mode == 'nmf':
+        A = np.clip(rng.normal(loc=.75, scale=.5, size=A.shape), 0, 1)
+        fixed[:] = 0
+    elif mode == 'optimize':
+        A[:, 0] = np.clip(A[:, 0] + rng.normal(scale=.2, size=A.shape[0]), 0, 1)
+        fixed[0] = 0
+    elif mode == 'add':
+        A[:, -1] = np.clip(rng.normal(loc=.75, scale=.5, size=A.shape[0]), 0, 1)
+        fixed[-1] = 0
+    return A, fixed
+
+
+def run_mode(mode, atlas, X, Y_true, args):
+    rng = np.random.default_rng(args.seed)
+    A0, fixed = mode_setup(mode, atlas, rng)
+    A0 = A0.astype(args.dtype)
+    kwargs = dict(beta=args.beta, eta=args.eta, n_iter=args.n_iter,
+                  normalize=True, engine=args.nnls_engine, solver=args.solver,
+                  warm_start=True)
+    (A, Y, history), sec, peak = measure(
+        lambda: run_deconvolution(A0.copy(), X, fixed, **kwargs),
+        args.repeat, not args.no_memory)
+
+    if mode == 'nmf':
+        order = match_columns(atlas.values, A)
+        Y = Y[order]
+    coef_rmse = np.sqrt(np.mean((Y - Y_true.values) ** 2))
+    return {'seconds': sec,
+            'samples_per_sec': X.shape[1] / sec,
+            'iterations': len(history),
+            'peak_mb': peak,
+            'rmse': float(history[-1]),
+            'coef_rmse': float(coef_rmse)}
+
+
+def run_benchmark(args):
+    atlas, data, Y_true = gen_data(args.features, args.samples, args.refs,
+                                   args.sparsity, args.noise, args.seed)
+    rep = (args.repeat, not args.no_memory)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, df in (('atlas', atlas), ('data', data)):
+            path = op.join(tmp_dir, f'{name}.csv')
+            df.to_csv(path, float_format='%.5f')
+            _, sec, peak = measure(lambda: load_table(path, dtype=args.dtype),
+                                   *rep)
+            results[f'load_table.{name}'] = {
+                'seconds': sec, 'mb_per_sec': op.getsize(path) / 2 ** 20 / sec,
+                'peak_mb': peak}
+        if args.sparsity:
+            path = op.join(tmp_dir, 'atlas.npz')
+            save_npz_table(path, atlas)
+            _, sec, peak = measure(lambda: load_table(path), *rep)
+            results['load_table.atlas_npz'] = {'seconds': sec, 'peak_mb': peak}
+
+    A = table_values(atlas).astype(args.dtype)
+    X = table_values(data).astype(args.dtype)
+    Y, sec, peak = measure(lambda: run_nnls(A, X, args.beta,
+                                            engine=args.nnls_engine),
+                           *rep)
+    results['run_nnls'] = {
+        'seconds': sec, 'samples_per_sec': X.shape[1] / sec, 'peak_mb': peak,
+        'coef_rmse': float(np.sqrt(np.mean((Y - Y_true.values) ** 2)))}
+
+    for mode in args.modes:
+        eprint(f'running {mode}...')
+        results[f'run_deconvolution.{mode}'] = run_mode(mode, atlas, X,
+                                                        Y_true, args)
+    return results
+
+#############################################################
+#                                                           #
+#             Reports                                       #
+#                                                           #
+#############################################################
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', '-C', dpath, 'rev-parse',
+                                        '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(old, new):
+    """ print the time and accuracy of the new results relative to the old """
+    print(f'{"benchmark":<32}{"old sec":>10}{"new sec":>10}{"speedup":>9}'
+          f'{"old coef_rmse":>15}{"new coef_rmse":>15}')
+    for name, res in new['results'].items():
+        prev = old['results'].get(name)
+        if prev is None:
+            continue
+        print(f'{name:<32}{prev["seconds"]:>10.4f}{res["seconds"]:>10.4f}'
+              f'{prev["seconds"] / res["seconds"]:>8.2f}x'
+              f'{prev.get("coef_rmse", np.nan):>15.3e}'
+              f'{res.get("coef_rmse", np.nan):>15.3e}')
+
+
+def main():
+    args = parse_args()
+    report = {'commit': git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'params': {k: v for k, v in vars(args).items()
+                         if k not in ('out', 'compare', 'no_memory')},
+              'results': run_benchmark(args)}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    eprint(f'dumped {args.out}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if old['params'] != report['params']:
+            eprint('Warning: the benchmarks were run with different parameters')
+        compare(old, report)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ssNMF on synthetic data: time, peak memory '
+                    'and accuracy of loading, NNLS and each deconvolution mode')
+    parser.add_argument('--features', type=int, default=10000,
+                        help='Number of features (rows) [10000]')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='Number of mixtures [200]')
+    parser.add_argument('--refs', type=int, default=10,
+                        help='Number of reference (atlas) columns [10]')
+    parser.add_argument('--sparsity', type=float, default=0.0,
+                        help='Fraction of zeros in the atlas [0.0]')
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help='sd of the Gaussian noise added to the '
+                             'mixtures [0.01]')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES,
+                        help='Deconvolution modes to run [all]')
+    parser.add_argument('--n_iter', type=int, default=50,
+                        help='Number of NMF iterations [50]')
+    parser.add_argument('--beta', type=float, default=0.0)
+    parser.add_argument('--eta', type=float, default=0.0)
+    parser.add_argument('--solver', choices=SOLVERS, default=SOLVERS[0])
+    parser.add_argument('--nnls_engine', choices=NNLS_ENGINES,
+                        default=NNLS_ENGINES[0])
+    parser.add_argument('--dtype', choices=DTYPES, default=DTYPES[0])
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Repeat each measurement, and keep the '
+                             'fastest [1]')
+    parser.add_argument('--no_memory', action='store_true',
+                        help='Do not measure peak memory (which takes an '
+                             'extra, slower, run per measurement)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', '-o', default='benchmark.json',
+                        help='Output json [benchmark.json]')
+    parser.add_argument('--compare', '-c',
+                        help='A previous output json to compare to')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
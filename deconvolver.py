@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse
+
+from algorithm import fcnnls, _project
+from utils_nmf import table_values
+
+#############################################################
+#                                                           #
+#             Repeated deconvolution with a fixed atlas     #
+#                                                           #
+#############################################################
+
+
+class Deconvolver:
+    """
+    Deconvolve batches of samples against a fixed atlas:
+        argmin_Y ||AY-X||^2 + beta*||Y||_1^2 s.t. Y >= 0
+    The Gram matrix A'A + beta and its Cholesky factorization are computed
+    once. Per batch, only A'X is computed. Samples whose unconstrained
+    solution is nonnegative are solved by the factorization alone, and
+    only the rest by fcnnls.
+
+    >>> dec = Deconvolver(atlas_df, beta=0.0)
+    >>> coef = dec.deconvolve(samples_df)
+    """
+
+    def __init__(self, atlas, beta=0.0, normalize=True, pool=None):
+        """
+        :param atlas: DataFrame, features by atlas columns (all fixed)
+        :param beta: regularization parameter, float
+        :param normalize: normalize the coefficients of each sample to sum
+                          up to one
+        :param pool: a parallel.NNLSPool to solve on. Default is serial
+        """
+        self.features = atlas.index
+        self.columns = atlas.columns
+        self.normalize = normalize
+        self.pool = pool
+        self.A = table_values(atlas)
+        self.AtA = _project(self.A, self.A) + beta
+        try:
+            self.cho = linalg.cho_factor(self.AtA)
+        except linalg.LinAlgError:
+            # singular Gram matrix (e.g. identical columns)
+            self.cho = None
+
+    @classmethod
+    def from_args(cls, args, pool=None):
+        """
+        Construct from parsed ssNMF.py arguments (--atlas, --exclude, --fix,
+        --optimize, --beta, ...). All remaining columns must be fixed.
+        """
+        from ssNMF import load_atlas, parse_cols
+        if args.atlas is None or args.add:
+            raise ValueError('a Deconvolver requires an atlas with no '
+                             'added columns')
+        atlas, fixed_bv = parse_cols(load_atlas(args, None), args)
+        if not fixed_bv.all():
+            raise ValueError('a Deconvolver requires all atlas columns '
+                             'to be fixed')
+        return cls(atlas, args.beta, not args.no_norm_weights, pool)
+
+    def align(self, X):
+        """ reorder the rows of a data table by the atlas features """
+        if X.shape[0] == len(self.features) and \
+                (X.index == self.features).all():
+            return table_values(X)
+        X = X.reindex(self.features)
+        if X.isnull().values.any():
+            raise ValueError('data has features missing from the atlas')
+        return table_values(X)
+
+    def solve(self, AtX):
+        """ the coefficients, given the projected data A'X """
+        Y = np.zeros((self.AtA.shape[0], AtX.shape[1]))
+        todo = np.ones(AtX.shape[1], dtype=bool)
+        if self.cho is not None:
+            Y = linalg.cho_solve(self.cho, AtX)
+            todo = (Y < 0).any(axis=0)
+        if todo.any():
+            solve = fcnnls if self.pool is None else self.pool.fcnnls
+            Y[:, todo] = solve(self.AtA, AtX[:, todo])
+        if self.normalize:
+            Y = Y / Y.sum(axis=0)
+        return Y
+
+    def deconvolve(self, X):
+        """
+        :param X: samples. A DataFrame (features by samples), whose rows are
+                  matched to the atlas features, or a numpy / scipy.sparse
+                  array with the rows ordered as the atlas features
+        :return: coefficients, atlas columns by samples. A DataFrame if X is
+        """
+        if not isinstance(X, pd.DataFrame):
+            if X.shape[0] != len(self.features):
+                raise ValueError(f'data has {X.shape[0]} features, '
+                                 f'atlas has {len(self.features)}')
+            if not sparse.issparse(X):
+                X = np.asarray(X, dtype=float)
+            return self.solve(_project(self.A, X))
+        Y = self.solve(_project(self.A, self.align(X)))
+        return pd.DataFrame(Y, index=self.columns, columns=X.columns)
@@ -0,0 +1,271 @@
+import numpy as np
+from multiprocessing import Pool, RawArray, shared_memory, resource_tracker
+
+from algorithm import fcnnls, nnls_columns, run_deconvolution, \
+    group_statistics, bootstrap_nnls
+
+# a restart is abandoned if, after RESTART_GRACE iterations, its objective
+# is worse by more than a margin than that of another restart at the same
+# or an earlier iteration
+RESTART_GRACE = 10
+RESTART_MARGIN = 0.1
+# features are resampled in this many random groups (see group_statistics)
+BOOTSTRAP_GROUPS = 1000
+# bootstrap replicates solved together, per task
+BOOTSTRAP_CHUNK = 16
+BOOTSTRAP_QUANTILES = (0.025, 0.975)
+# fcnnls solves its columns together, so smaller chunks only add overhead
+FCNNLS_MIN_CHUNK = 1024
+
+#############################################################
+#                                                           #
+#             Multi-process NNLS                            #
+#                                                           #
+#############################################################
+
+# shared memory blocks attached by a worker process, by slot
+_attached = {}
+
+
+def _attach(slot, name):
+    cur = _attached.get(slot)
+    if cur is not None and cur.name == name:
+        return cur
+    if cur is not None:
+        cur.close()
+    _attached[slot] = shm = shared_memory.SharedMemory(name=name)
+    return shm
+
+
+def _view(spec):
+    slot, name, shape = spec
+    return np.ndarray(shape, dtype=float, buffer=_attach(slot, name).buf)
+
+
+def _nnls_chunk(args):
+    M, B, out, start, end = args
+    _view(out)[:, start:end] = nnls_columns(_view(M), _view(B)[:, start:end])
+
+
+def _fcnnls_chunk(args):
+    G, B, out, start, end, init = args
+    if init is not None:
+        init = _view(init)[:, start:end]
+    _view(out)[:, start:end] = fcnnls(_view(G), _view(B)[:, start:end], init)
+
+
+class NNLSPool:
+    """
+    A process pool solving NNLS problems column-chunk by column-chunk.
+    The matrices are copied once per call into shared memory blocks,
+    which are reused across calls, so the workers only receive
+    the names of the blocks and a range of columns.
+    """
+
+    def __init__(self, threads, chunks_per_thread=4):
+        self.threads = threads
+        self.chunks_per_thread = chunks_per_thread
+        # start the resource tracker before forking, so the workers share
+        # it with the parent, who owns (and unlinks) the shared blocks
+        resource_tracker.ensure_running()
+        self.pool = Pool(threads)
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks = {}
+
+    def _share(self, slot, arr=None, shape=None):
+        """
+        Get a shared array for this slot, reallocating the underlying
+        block only if it is too small. Copy arr into it, if specified.
+        """
+        shape = arr.shape if arr is not None else shape
+        nbytes = max(int(np.prod(shape)) * 8, 1)
+        shm = self.blocks.get(slot)
+        if shm is None or shm.size < nbytes:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.blocks[slot] = shm
+        view = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        if arr is not None:
+            view[:] = arr
+        return view, (slot, shm.name, shape)
+
+    def _ranges(self, nr_cols, min_chunk=1):
+        nr_chunks = min(nr_cols // min_chunk,
+                        self.threads * self.chunks_per_thread)
+        bounds = np.linspace(0, nr_cols, max(nr_chunks, 1) + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _map(self, func, M, B, ranges, *extra):
+        _, mspec = self._share('M', M)
+        _, bspec = self._share('B', B)
+        out, ospec = self._share('out', shape=(M.shape[1], B.shape[1]))
+        tasks = [(mspec, bspec, ospec, s, e) + extra for s, e in ranges]
+        self.pool.map(func, tasks)
+        return out.copy()
+
+    def nnls_columns(self, M, B):
+        """ same as algorithm.nnls_columns """
+        return self._map(_nnls_chunk, M, B, self._ranges(B.shape[1]))
+
+    def fcnnls(self, AtA, AtB, init=None):
+        """
+        same as algorithm.fcnnls. Problems of fewer than two chunks of
+        FCNNLS_MIN_CHUNK columns are solved in this process
+        """
+        ranges = self._ranges(AtB.shape[1], FCNNLS_MIN_CHUNK)
+        if len(ranges) == 1:
+            return fcnnls(AtA, AtB, init)
+        ispec = None if init is None else self._share('init', init)[1]
+        return self._map(_fcnnls_chunk, AtA, AtB, ranges, ispec)
+
+
+#############################################################
+#                                                           #
+#             Multi-restart NMF                             #
+#                                                           #
+#############################################################
+
+# the data and the objective traces, shared by all restarts of a process
+_restart = {}
+
+
+def _init_restart(X, fixed, trace, grace, margin, kwargs):
+    nr_restarts = len(trace) // kwargs['n_iter']
+    _restart.update(X=X, fixed=fixed, grace=grace, margin=margin,
+                    kwargs=kwargs, trace=np.frombuffer(trace).reshape(
+                        nr_restarts, kwargs['n_iter']))
+
+
+def _run_restart(task):
+    r, A = task
+    trace, grace, margin = _restart['trace'], _restart['grace'], _restart['margin']
+    abandoned = False
+
+    def callback(it, obj):
+        nonlocal abandoned
+        trace[r, it] = obj
+        others = np.delete(trace[:, :it + 1], r, axis=0)
+        if it + 1 < grace or np.isnan(others).all():
+            return False
+        abandoned = obj > np.nanmin(others) * (1 + margin)
+        return abandoned
+
+    A, Y, history = run_deconvolution(A, _restart['X'], _restart['fixed'],
+                                      callback=callback, **_restart['kwargs'])
+    return r, A, Y, history, trace[r, len(history) - 1], abandoned
+
+
+def run_restarts(inits, X, fixed, threads, grace=RESTART_GRACE,
+                 margin=RESTART_MARGIN, **kwargs):
+    """
+    Run NMF from several initial atlases, concurrently on a process pool.
+    The data is passed once to every process. Each restart publishes its
+    objective per iteration, and is abandoned when it is clearly losing
+    (see RESTART_GRACE).
+    :param inits: list of initial atlases, one per restart
+    :param threads: number of processes
+    :param kwargs: other arguments for algorithm.run_deconvolution
+    :return: the index of the best restart, its atlas, coefficients and
+             RMSE history, and per restart a tuple of
+             (objective, number of iterations, abandoned)
+    """
+    nr_restarts = len(inits)
+    trace = RawArray('d', nr_restarts * kwargs['n_iter'])
+    np.frombuffer(trace)[:] = np.nan
+    initargs = (X, fixed, trace, grace, margin, kwargs)
+    tasks = list(enumerate(inits))
+
+    best, summary = None, [None] * nr_restarts
+    threads = min(threads, nr_restarts)
+    if threads > 1:
+        pool = Pool(threads, _init_restart, initargs)
+        results = pool.imap_unordered(_run_restart, tasks)
+    else:
+        pool = None
+        _init_restart(*initargs)
+        results = map(_run_restart, tasks)
+    for r, A, Y, history, obj, abandoned in results:
+        summary[r] = (obj, len(history), abandoned)
+        if best is None or obj < best[0]:
+            best = (obj, r, A, Y, history)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return best[1:], summary
+
+
+#############################################################
+#                                                           #
+#             Bootstrap                                     #
+#                                                           #
+#############################################################
+
+# the group statistics, shared by all bootstrap tasks of a process
+_bootstrap = {}
+
+
+def _init_bootstrap(AtA, AtX, beta, normalize):
+    _bootstrap.update(AtA=AtA, AtX=AtX, beta=beta, normalize=normalize)
+
+
+def _run_bootstrap(task):
+    start, seeds = task
+    nr_groups = _bootstrap['AtA'].shape[0]
+    counts = np.array([np.bincount(np.random.default_rng(s).integers(
+        nr_groups, size=nr_groups), minlength=nr_groups) for s in seeds])
+    return start, bootstrap_nnls(_bootstrap['AtA'], _bootstrap['AtX'], counts,
+                                 _bootstrap['beta'], _bootstrap['normalize'])
+
+
+def run_bootstrap(A, X, nr_replicates, beta, normalize, seed, threads,
+                  groups=BOOTSTRAP_GROUPS, chunk=BOOTSTRAP_CHUNK):
+    """
+    Bootstrap the NNLS coefficients of X on a fixed atlas, resampling the
+    features with replacement, concurrently on a process pool.
+    The features are resampled in random groups, whose statistics are
+    computed once (a single pass over X). A replicate then costs
+    groups / nr_features of a full projection. With at least as many
+    groups as features, this is the plain feature bootstrap.
+    Every replicate draws from its own seed (spawned from seed), so the
+    results do not depend on the number of processes.
+    :param nr_replicates: number of bootstrap replicates
+    :param threads: number of processes
+    :param groups: number of groups of features
+    :return: the coefficients per replicate, size
+             (nr_replicates, nr_ref_samp, nr_samp)
+    """
+    seq = np.random.SeedSequence(seed)
+    AtA, AtX = group_statistics(A, X, groups, seq.spawn(1)[0])
+    seeds = seq.spawn(nr_replicates)
+    tasks = [(s, seeds[s:s + chunk]) for s in range(0, nr_replicates, chunk)]
+    initargs = (AtA, AtX, beta, normalize)
+    Y = np.empty((nr_replicates, A.shape[1], X.shape[1]))
+    threads = min(threads, len(tasks))
+    if threads > 1:
+        pool = Pool(threads, _init_bootstrap, initargs)
+        results = pool.imap_unordered(_run_bootstrap, tasks)
+    else:
+        pool = None
+        _init_bootstrap(*initargs)
+        results = map(_run_bootstrap, tasks)
+    for start, Y_chunk in results:
+        Y[start:start + len(Y_chunk)] = Y_chunk
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return Y
@@ -1,8 +1,56 @@
+import glob
 import argparse
-from utils_nmf import eprint, mkdir_p
+from utils_nmf import eprint, mkdir_p, file_stems, missing_format_module, \
+    DEF_NR_THREADS, DEF_CACHE_DIR, DEF_CACHE_SIZE, OUT_FORMATS, DTYPES, \
+    BINARY_EXTS, STREAM_CHUNK
+from algorithm import NNLS_ENGINES, SOLVERS, INITS, ONLINE_DECAY, \
+    MARKER_SCORES
+from parallel import RESTART_MARGIN, BOOTSTRAP_GROUPS, BOOTSTRAP_QUANTILES
 
 
 def validate_args(args):
+    # --data may list several files, or quoted globs
+    if args.data is None:
+        # remote workers load their own data
+        if not args.listen:
+            eprint('Invalid input: --data is required (unless --listen)')
+            exit()
+        args.data = []
+    args.data_files = [f for pat in args.data for f in sorted(glob.glob(pat)) or [pat]]
+    args.data = args.data_files[0] if args.data_files else None
+    if args.workers:
+        if args.stream or args.restarts > 1 or args.batch_size or \
+                args.bootstrap or args.checkpoint_every or args.resume or \
+                args.result_cache or args.project_back:
+            eprint('Invalid input: --workers with --stream, --restarts, '
+                   '--batch_size, --bootstrap, checkpoints, --result_cache '
+                   'or --project_back')
+            exit()
+        if args.nnls_engine != 'fcnnls':
+            eprint('Invalid input: --workers requires --nnls_engine fcnnls')
+            exit()
+        if args.init != 'random':
+            eprint('Invalid input: --workers requires --init random')
+            exit()
+    elif args.listen:
+        eprint('Invalid input: --listen requires --workers')
+        exit()
+    elif len(args.data_files) > 1:
+        stems = file_stems(args.data_files)
+        if len(set(stems)) < len(stems):
+            dups = sorted({s for s in stems if stems.count(s) > 1})
+            eprint(f'Invalid input: several data files map to the same '
+                   f'output name: {", ".join(dups)}')
+            exit()
+        if args.nmf_cols or args.add:
+            eprint('Invalid input: several data files in NMF mode (--nmf_cols '
+                   'or --add). All atlas columns must be fixed')
+            exit()
+        if args.stream or args.restarts > 1 or args.batch_size or \
+                args.bootstrap or args.checkpoint_every or args.resume:
+            eprint('Invalid input: several data files with --stream, '
+                   '--restarts, --batch_size, --bootstrap or checkpoints')
+            exit()
     if args.nmf_cols:
         if args.add > 0:
             eprint('Invalid input: --add must be zero in NMF mode')
@@ -16,19 +64,96 @@ def validate_args(args):
         if args.nmf_cols < 2:
             eprint('Invalid input: --nmf_cols must be >=2 in NMF mode ')
             exit()
+        if args.stream:
+            eprint('Invalid input: --stream in NMF mode ')
+            exit()
+    if args.restarts > 1:
+        if not (args.nmf_cols or args.add):
+            eprint('Invalid input: --restarts requires random columns '
+                   '(--nmf_cols or --add)')
+            exit()
+        if args.stream:
+            eprint('Invalid input: --restarts with --stream')
+            exit()
+        if args.init != 'random':
+            eprint('Invalid input: --restarts requires --init random')
+            exit()
+    if args.markers or args.feature_index:
+        if args.markers and args.nmf_cols:
+            eprint('Invalid input: --markers in NMF mode. Use --feature_index')
+            exit()
+        if args.stream:
+            eprint('Invalid input: --markers / --feature_index with --stream')
+            exit()
+    elif args.project_back:
+        eprint('Invalid input: --project_back requires --markers or '
+               '--feature_index')
+        exit()
+    if args.stream and args.data.endswith(BINARY_EXTS):
+        eprint('Invalid input: --stream reads csv data only')
+        exit()
+    if args.bootstrap and args.stream:
+        eprint('Invalid input: --bootstrap with --stream')
+        exit()
+    if args.result_cache:
+        if args.nmf_cols or args.add:
+            eprint('Invalid input: --result_cache in NMF mode (--nmf_cols '
+                   'or --add). All atlas columns must be fixed')
+            exit()
+        if args.stream or args.batch_size or args.checkpoint_every or args.resume:
+            eprint('Invalid input: --result_cache with --stream, --batch_size '
+                   'or checkpoints')
+            exit()
+    if args.checkpoint_every or args.resume:
+        if args.stream or args.restarts > 1 or args.batch_size:
+            eprint('Invalid input: --checkpoint_every / --resume with '
+                   '--stream, --restarts or --batch_size')
+            exit()
+    if args.batch_size:
+        if args.stream or args.restarts > 1:
+            eprint('Invalid input: --batch_size with --stream or --restarts')
+            exit()
+        if args.nnls_engine != 'fcnnls':
+            eprint('Invalid input: --batch_size requires --nnls_engine fcnnls')
+            exit()
+        if args.init == 'residual':
+            eprint('Invalid input: --batch_size with --init residual')
+            exit()
+    # the outputs are written after all the work
+    module = missing_format_module(args.out_format)
+    if module:
+        eprint(f'Invalid input: --out_format {args.out_format} requires '
+               f'{module}, which is not installed')
+        exit()
     if args.eta:
         assert args.eta >= 0, '--eta must be non negative'
     assert args.beta >= 0, '--beta must be non negative'
     assert args.n_iter > 0, '--n_iter must be positive'
+    assert args.tol >= 0, '--tol must be non negative'
+    assert args.patience > 0, '--patience must be positive'
     assert args.add >= 0, '--add must be non negative'
+    assert args.threads > 0, '--threads must be positive'
+    assert args.restarts > 0, '--restarts must be positive'
+    assert args.restart_margin >= 0, '--restart_margin must be non negative'
+    assert args.chunk_size > 0, '--chunk_size must be positive'
+    assert args.batch_size >= 0, '--batch_size must be non negative'
+    assert args.decay >= 0, '--decay must be non negative'
+    assert args.checkpoint_every >= 0, '--checkpoint_every must be non negative'
+    assert args.workers >= 0, '--workers must be non negative'
+    assert args.markers >= 0, '--markers must be non negative'
+    assert args.bootstrap >= 0, '--bootstrap must be non negative'
+    assert args.bootstrap_groups > 0, '--bootstrap_groups must be positive'
+    assert all(0 <= q <= 1 for q in args.quantiles), '--quantiles must be in [0, 1]'
+    assert args.cache_size > 0, '--cache_size must be positive'
 
     pref = args.prefix
     if '/' in pref:
         mkdir_p(pref[:pref.rfind('/')])
 
 
-def parse_args():
-    parser = argparse.ArgumentParser()
+def build_parser(description=None):
+    """ the ssNMF.py argument parser, to be extended by other scripts """
+    parser = argparse.ArgumentParser(description=description)
     patlas = parser.add_mutually_exclusive_group(required=True)
 
     # required arguments
@@ -40,8 +165,16 @@ def parse_args():
     patlas.add_argument('--nmf_cols', '-m', type=int,
                         help='Number of columns for the atlas for the '
                              'NMF to learn')
-    parser.add_argument('--data', '-i', required=True,
-                        help='Sample/data table. A csv file')
+    parser.add_argument('--data', '-i', nargs='+',
+                        help='Sample/data table. A csv file. Several files '
+                             '(or globs) are deconvolved on the same atlas, '
+                             'whose columns must all be fixed, on --threads '
+                             'processes. Each file gets a '
+                             '<prefix>.<file name>.coef.csv (the path '
+                             'relative to the common directory of the files, '
+                             'without the last extension), and all samples '
+                             'are saved together to <prefix>.coef.csv. '
+                             'Required, unless --listen')
 
     # arguments for the --atlas option:
     pcols = parser.add_mutually_exclusive_group()
@@ -68,6 +201,13 @@ def parse_args():
     # Other
     parser.add_argument('--n_iter', type=int, default=100,
                         help='Number of iterations for the (ss)NMF algorithm.')
+    parser.add_argument('--tol', type=float, default=0.0,
+                        help='Stop before --n_iter iterations when the '
+                             'relative change of the objective is smaller '
+                             'than tol for --patience consecutive iterations. '
+                             'Default is 0.0 (always run --n_iter iterations)')
+    parser.add_argument('--patience', type=int, default=1,
+                        help='See --tol. Default is 1')
     parser.add_argument('--beta', type=float, default=0.0,
                         help='L1 regularization on proportions. '
                              'Must be non negative. '
@@ -76,20 +216,189 @@ def parse_args():
                         help='L1 regularization on newly learned components. '
                              'Must be non negative. '
                              'Default value is 0.0')
+    parser.add_argument('--init', choices=INITS, default=INITS[0],
+                        help='Initialization of the unknown columns '
+                             '(--nmf_cols / --add). random draws them (see '
+                             '--seed). nndsvd and nndsvda are deterministic, '
+                             'from the SVD of the data (nndsvda replaces '
+                             'zeros by the data mean). residual is nndsvda '
+                             'of the residual of an NNLS fit of the data on '
+                             'the other atlas columns (for --add). '
+                             f'Default is {INITS[0]}')
+    parser.add_argument('--solver', choices=SOLVERS, default=SOLVERS[0],
+                        help='NMF update rule. anls solves an exact NNLS '
+                             'problem in each step. hals (hierarchical '
+                             'alternating least squares) and mu '
+                             '(multiplicative updates) perform a single, much '
+                             'cheaper update per step, and typically need '
+                             'more iterations. Ignored if all atlas columns '
+                             f'are fixed. Default is {SOLVERS[0]}')
+    parser.add_argument('--nnls_engine', choices=NNLS_ENGINES,
+                        default=NNLS_ENGINES[0],
+                        help='NNLS solver. fcnnls solves all samples (or '
+                             'features) together from the Gram matrix. '
+                             'scipy runs scipy.optimize.nnls per column. '
+                             f'Default is {NNLS_ENGINES[0]}')
+    parser.add_argument('--no_warm_start', action='store_true',
+                        help='Solve every NNLS step from scratch, rather '
+                             'than starting from the previous iteration '
+                             'solution (fcnnls engine only)')
+    parser.add_argument('--restarts', type=int, default=1,
+                        help='Number of differently seeded factorizations '
+                             'to run concurrently (on --threads processes). '
+                             'The best one is kept, and a summary is saved '
+                             'to <prefix>.restarts.csv. Restart i is seeded '
+                             'with --seed + i. Default is 1')
+    parser.add_argument('--restart_margin', type=float, default=RESTART_MARGIN,
+                        help='Abandon a restart whose objective is worse by '
+                             'this relative margin than another restart at '
+                             'the same or an earlier iteration. '
+                             f'Default is {RESTART_MARGIN}')
+    pmarkers = parser.add_mutually_exclusive_group()
+    pmarkers.add_argument('--markers', type=int, default=0,
+                          help='Deconvolve on marker features only: the '
+                               'features most specific to each atlas column '
+                               '(see --marker_score), this many per column. '
+                               'Features are scored on the input atlas '
+                               'columns (not --add). The selection is saved '
+                               'to <prefix>.markers.csv, to be reused with '
+                               '--feature_index. The RMSE and the output '
+                               'atlas are on the selected features (see '
+                               '--project_back). Default is 0 (all features)')
+    pmarkers.add_argument('--feature_index',
+                          help='Deconvolve on the features listed in the '
+                               'first column of this csv (e.g. the '
+                               '<prefix>.markers.csv of a previous run)')
+    parser.add_argument('--marker_score', choices=MARKER_SCORES,
+                        default=MARKER_SCORES[0],
+                        help='Score of the --markers. specificity is the '
+                             'margin by which a column is above (or below) '
+                             'all other columns. variance is the variance '
+                             'across the columns, keeping --markers times '
+                             'the number of columns features. '
+                             f'Default is {MARKER_SCORES[0]}')
+    parser.add_argument('--project_back', action='store_true',
+                        help='With --markers / --feature_index, output the '
+                             'atlas on all features: the learned columns are '
+                             'fitted to the data of all features, given the '
+                             'coefficients. The RMSE is then on all features')
+    parser.add_argument('--result_cache',
+                        help='A database file (sqlite) of the coefficients '
+                             'of every sample, keyed by the sample values, '
+                             'the atlas, --beta and the normalization. Only '
+                             'samples missing from it are solved. Requires '
+                             'all atlas columns to be fixed')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Split the samples among this many worker '
+                             'processes, each solving the coefficients of its '
+                             'samples and sending back only their statistics '
+                             'for the atlas update. Workers are started '
+                             'locally, each loading a range of the columns '
+                             'of --data (or of the data files), unless '
+                             '--listen is set. Default is 0 (off)')
+    parser.add_argument('--listen',
+                        help='With --workers, wait for remote workers '
+                             '(shards.py --connect) on this address, '
+                             'host:port or a unix socket path, instead of '
+                             'starting them. Each worker loads its own data '
+                             'files. The coordinator and the workers share '
+                             'a secret, $SSNMF_AUTHKEY')
+    parser.add_argument('--checkpoint_every', type=int, default=0,
+                        help='Save the state of the NMF to '
+                             '<prefix>.checkpoint.npz every this many '
+                             'iterations, to continue an interrupted run '
+                             'with --resume. The checkpoint is removed when '
+                             'the run completes. Default is 0 (never)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue from <prefix>.checkpoint.npz. All '
+                             'other arguments must be the same as in the '
+                             'interrupted run (except --n_iter), and the '
+                             'results are identical to those of an '
+                             'uninterrupted run')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='Number of bootstrap replicates of the features, '
+                             'to estimate the uncertainty of the coefficients. '
+                             'Each replicate is an NNLS of the data on the '
+                             'resulting (fixed) atlas. The mean, sd and '
+                             '--quantiles of each coefficient are saved to '
+                             '<prefix>.coef.<stat>.csv. Default is 0 (off)')
+    parser.add_argument('--bootstrap_groups', type=int, default=BOOTSTRAP_GROUPS,
+                        help='Resample the features in this many random groups. '
+                             'Fewer groups are faster; at least as many as '
+                             'the features is the plain feature bootstrap. '
+                             f'Default is {BOOTSTRAP_GROUPS}')
+    parser.add_argument('--quantiles', type=float, nargs='+',
+                        default=BOOTSTRAP_QUANTILES,
+                        help='Quantiles of the bootstrap coefficients to save. '
+                             f'Default is {" ".join(map(str, BOOTSTRAP_QUANTILES))}')
+    parser.add_argument('--batch_size', type=int, default=0,
+                        help='Online mode: learn the atlas from mini-batches '
+                             'of this many samples, updating it after each '
+                             'batch. --n_iter is then the number of passes '
+                             '(epochs) over the data. With --cache_dir, the '
+                             'data is memory-mapped and read one batch at a '
+                             'time, for cohorts too large to factorize at '
+                             'once. Default is 0 (off)')
+    parser.add_argument('--decay', type=float, default=ONLINE_DECAY,
+                        help='Online mode: forgetting of the statistics of '
+                             'previous batches. At the t-th batch, they are '
+                             'weighted by (1 - 1/t) ** decay. 0 weights all '
+                             f'batches equally. Default is {ONLINE_DECAY}')
+    parser.add_argument('--dtype', choices=DTYPES, default=DTYPES[0],
+                        help='Precision of the data, the atlas and the '
+                             'results. float32 halves the memory, and speeds '
+                             'up the products with the data. Small (Gram) '
+                             'matrices and the error are still computed in '
+                             'float64. Not used with --stream. '
+                             f'Default is {DTYPES[0]}')
     parser.add_argument('--norm_data', action='store_true',
                         help='normalize the input data such that each '
                              'sample will sum up to one.')
     parser.add_argument('--no_norm_weights', action='store_true',
                         help='Do not normalize the output weights. '
                              'If set, their sum may not sum up to one.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the data table in chunks of rows '
+                             '(features), keeping in memory only their '
+                             'projection on the atlas. For data tables too '
+                             'large to load. Only when all atlas columns are '
+                             'fixed (plain NNLS)')
+    parser.add_argument('--chunk_size', type=int, default=STREAM_CHUNK,
+                        help='Number of values (rows x samples) per chunk '
+                             'for --stream. Memory grows with it, whatever '
+                             f'the number of samples [{STREAM_CHUNK}]')
+    parser.add_argument('--cache_dir', default=DEF_CACHE_DIR,
+                        help='Directory for a cache of parsed input tables '
+                             '(binary, memory-mapped). Tables are re-parsed '
+                             'only when their content changes. Default is '
+                             '$SSNMF_CACHE_DIR, or no caching if unset')
+    parser.add_argument('--cache_size', type=float, default=DEF_CACHE_SIZE,
+                        help='Max size of the cache, in GB. Least recently '
+                             f'used tables are evicted [{DEF_CACHE_SIZE}]')
     parser.add_argument('--prefix', '-p', default='./out',
                         help='prefix for output files (csv and png)')
+    parser.add_argument('--out_format', choices=OUT_FORMATS,
+                        default=OUT_FORMATS[0],
+                        help='Format of the output atlas and coefficients. '
+                             'csv is rounded to 5 decimal digits. npz, '
+                             'parquet (requires pyarrow) and hdf5 (requires '
+                             f'pytables) are lossless. Default is {OUT_FORMATS[0]}')
     parser.add_argument('--verbose', '-v', action='store_true')
     parser.add_argument('--seed', type=int,
             help='seed for the random generator (numpy.random.seed)')
     parser.add_argument('--plot', action='store_true')
-    # parser.add_argument('--threads', '-@', type=int, default=DEF_NR_THREADS,
-    #                     help='Number of threads [cpu_count()]')
-    return parser.parse_args()
+    parser.add_argument('--profile', action='store_true',
+                        help='Save the time of each phase (loading, NNLS '
+                             'steps, dumping...), NNLS counts, a per '
+                             'iteration trace and peak memory to '
+                             '<prefix>.profile.json')
+    parser.add_argument('--threads', '-@', type=int, default=DEF_NR_THREADS,
+                        help='Number of processes for the NNLS steps '
+                             '[cpu_count()]')
+    return parser
+
+
+def parse_args():
+    return build_parser().parse_args()
 
 
@@ -6,8 +6,7 @@ import numpy as np
 import matplotlib.pylab as plt
 from matplotlib.colors import LinearSegmentedColormap
 import seaborn as sns
-import pandas as pd
-from utils_nmf import eprint, validate_file
+from utils_nmf import eprint, validate_file, read_table
 
 plt.rcParams.update({'font.size': 12})
 
@@ -21,15 +20,12 @@ cm = LinearSegmentedColormap.from_list('my_gradient', (
 
 def plot_atlas(atlas_path, pdf_path=None, nan_orig=False):
     validate_file(atlas_path)
-    if not atlas_path.endswith('.csv'):
-        eprint('Error setting pdf path')
-        exit()
     if pdf_path is None:
-        pdf_path = atlas_path[:-4] + '.pdf'
+        pdf_path = op.splitext(atlas_path)[0] + '.pdf'
     # plt.rcParams.update({'font.size': 20})
     plt.figure()
     # cm = sns.color_palette("coolwarm", as_cmap=True)
-    df = pd.read_csv(atlas_path, index_col=0)
+    df = read_table(atlas_path)
     if nan_orig:
         for c in df.columns:
             if 'Unknown' in c:
@@ -51,12 +47,12 @@ def plot_atlas(atlas_path, pdf_path=None, nan_orig=False):
 
 def plot_weights(coef_path):
     validate_file(coef_path)
-    if not coef_path.endswith('.csv'):
-        eprint('Error setting pdf path')
-        exit()
-    pdf_path = coef_path[:-9] + '.weights.pdf'
+    pdf_path = op.splitext(coef_path)[0]
+    if pdf_path.endswith('.coef'):
+        pdf_path = pdf_path[:-5]
+    pdf_path += '.weights.pdf'
     plt.figure()
-    df = pd.read_csv(coef_path, index_col=0)
+    df = read_table(coef_path)
     ax = sns.heatmap(data=df, vmax=1, vmin=0, cmap='Reds')
     ax.set_ylabel('Reference')
     ax.set_xlabel('Samples')
@@ -78,7 +74,7 @@ def main():
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('atlas_path', help='Atlas csv to plot')
+    parser.add_argument('atlas_path', help='Atlas to plot (csv, npz, parquet or h5)')
     parser.add_argument('--outpath', '-o', help='output path (pdf or png)')
     return parser.parse_args()
 
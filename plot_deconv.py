@@ -13,7 +13,7 @@ import matplotlib.pylab as plt
 import matplotlib.cm
 import matplotlib.colors
 import seaborn as sns
-from utils_nmf import eprint, validate_file
+from utils_nmf import eprint, validate_file, read_table
 plt.rcParams.update({'font.size': 12})
 
 # Plotting parameters:
@@ -31,7 +31,7 @@ class PlotDeconv:
         self.full_legend = full_legend
         self.stubs = stubs
         self.validate_params()
-        self.df = pd.read_csv(csv, index_col=0).fillna(0)
+        self.df = read_table(csv).fillna(0)
         self.plot_res()
 
     def validate_params(self):
@@ -166,7 +166,8 @@ def main():
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('csv', help='Deconvolution output csv to plot')
+    parser.add_argument('csv', help='Deconvolution output to plot (csv, npz, '
+                                    'parquet or h5)')
     parser.add_argument('--outpath', '-o', help='output. Default is the same name as CSV, but different suffix')
     parser.add_argument('--show', action='store_true', help='Show the figure in a pop up window')
     parser.add_argument('--min_rate', type=float, default=1.0,
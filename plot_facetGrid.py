@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import pandas as pd
 import numpy as np
 import argparse
 import os.path as op
@@ -10,7 +9,7 @@ if 'DISPLAY' not in os.environ.keys():
     matplotlib.use('Agg')
 import matplotlib.pylab as plt
 import seaborn as sns
-from utils_nmf import eprint, validate_file
+from utils_nmf import eprint, validate_file, read_table
 
 # Plotting parameters:
 NCOL = 6
@@ -19,7 +18,7 @@ plt.rcParams.update({'font.size': 12})
 
 def load_data(args):
     validate_file(args.csv)
-    df = pd.read_csv(args.csv)
+    df = read_table(args.csv).reset_index()
     df.columns = ['component'] + list(df.columns)[1:]
     if args.include:
         df = df[df['component'].isin(args.include)]
@@ -54,7 +53,8 @@ def main():
 def parse_args():
     parser = argparse.ArgumentParser()
     # required arguments
-    parser.add_argument('csv', help='Deconvolution output csv to plot')
+    parser.add_argument('csv', help='Deconvolution output to plot (csv, npz, '
+                                    'parquet or h5)')
     oparser = parser.add_mutually_exclusive_group(required=True)
     oparser.add_argument('--outpath', '-o', help='output. Default is the same name as CSV, but different suffix')
     oparser.add_argument('--show', action='store_true', help='Show the figure in a pop up window')
@@ -0,0 +1,101 @@
+import json
+import time
+import resource
+import functools
+
+#############################################################
+#                                                           #
+#             Profiling (--profile)                         #
+#                                                           #
+#############################################################
+
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB (on Linux)
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class Profiler:
+    """
+    Collect the wall time of phases, counters (e.g. NNLS calls) and a
+    trace of the NMF iterations. Disabled by default, in which case
+    every method returns right away.
+    Phases are timed either by the profiled decorator, or as laps within
+    an iteration: start_iteration(), then lap(name) at the end of each
+    phase, then end_iteration().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}        # name -> [calls, seconds]
+        self.counters = {}      # name -> count
+        self.iterations = []
+        self._start = self._lap = None
+        self._iter = self._iter_counters = None
+
+    def enable(self):
+        self.enabled = True
+        self._start = time.perf_counter()
+
+    def add(self, name, seconds):
+        phase = self.phases.setdefault(name, [0, 0.0])
+        phase[0] += 1
+        phase[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_iteration(self):
+        if self.enabled:
+            self._lap = time.perf_counter()
+            self._iter = {}
+            self._iter_counters = dict(self.counters)
+
+    def lap(self, name):
+        """ end the phase name of the current iteration """
+        if self.enabled:
+            now = time.perf_counter()
+            self._iter[name] = self._iter.get(name, 0) + now - self._lap
+            self.add(name, now - self._lap)
+            self._lap = now
+
+    def end_iteration(self, **values):
+        """ record the iteration, with additional values (e.g. rmse) """
+        if self.enabled:
+            counters = {k: v - self._iter_counters.get(k, 0)
+                        for k, v in self.counters.items()
+                        if v != self._iter_counters.get(k, 0)}
+            self.iterations.append({'iteration': len(self.iterations) + 1,
+                                    'seconds': self._iter, **counters,
+                                    **values, 'max_rss_mb': max_rss_mb()})
+
+    def dump(self, path):
+        report = {'total_seconds': time.perf_counter() - self._start,
+                  'max_rss_mb': max_rss_mb(),
+                  'max_rss_children_mb': max_rss_mb(resource.RUSAGE_CHILDREN),
+                  'phases': {name: {'calls': calls, 'seconds': sec}
+                             for name, (calls, sec) in self.phases.items()},
+                  'counters': self.counters,
+                  'iterations': self.iterations}
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+prof = Profiler()
+
+
+def profiled(name):
+    """ decorator: time every call of the function as the phase name """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not prof.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                prof.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+import os.path as op
+import numpy as np
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from algorithm import _project
+from deconvolver import Deconvolver
+from utils_nmf import eprint, load_table, TableCache, DEF_CACHE_DIR, \
+    DEF_CACHE_SIZE
+
+#############################################################
+#                                                           #
+#             Batching concurrent requests                  #
+#                                                           #
+#############################################################
+
+
+class Batcher:
+    """
+    Solve the requests for one atlas on a single thread. Requests that
+    arrive while a batch is being solved are solved together, as one
+    NNLS problem.
+    """
+
+    def __init__(self, dec, max_batch, max_wait):
+        self.dec = dec
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, X):
+        """
+        Deconvolve X (features by samples, ordered as the atlas features).
+        The projection A'X is computed on the calling thread.
+        """
+        req = {'AtX': _project(self.dec.A, X), 'done': threading.Event()}
+        self.queue.put(req)
+        req['done'].wait()
+        if 'error' in req:
+            raise req['error']
+        return req['Y']
+
+    def _collect(self):
+        reqs = [self.queue.get()]
+        nr_samples = reqs[0]['AtX'].shape[1]
+        deadline = time.monotonic() + self.max_wait
+        while nr_samples < self.max_batch:
+            try:
+                req = self.queue.get(timeout=max(deadline - time.monotonic(), 0)) \
+                    if self.max_wait else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            reqs.append(req)
+            nr_samples += req['AtX'].shape[1]
+        return reqs
+
+    def _run(self):
+        while True:
+            reqs = self._collect()
+            try:
+                Y = self.dec.solve(np.hstack([r['AtX'] for r in reqs]))
+                bounds = np.cumsum([r['AtX'].shape[1] for r in reqs])[:-1]
+                for req, y in zip(reqs, np.hsplit(Y, bounds)):
+                    req['Y'] = y
+            except Exception as e:
+                for req in reqs:
+                    req['error'] = e
+            for req in reqs:
+                req['done'].set()
+
+#############################################################
+#                                                           #
+#             HTTP interface                                #
+#                                                           #
+#############################################################
+
+
+class HTTPError(Exception):
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
+
+
+def parse_samples(body, content_type, dec):
+    """
+    Parse a request body into (sample names, data array ordered as the
+    atlas features). Either a csv table (features by samples, with a
+    header line), or json: {"samples": {name: [values]}}, where the values
+    are ordered as the atlas features, or as an optional "features" list.
+    """
+    if content_type.startswith('text/csv'):
+        df = pd.read_csv(io.BytesIO(body), index_col=0)
+    else:
+        d = json.loads(body)
+        if 'features' not in d:
+            # fast path: no need to match features
+            X = np.array(list(d['samples'].values()), dtype=float).T
+            if X.ndim != 2 or X.shape[0] != len(dec.features):
+                raise HTTPError(400, f'samples must have {len(dec.features)} '
+                                     'values, ordered as the atlas features')
+            return list(d['samples']), X
+        df = pd.DataFrame(d['samples'], index=d['features'], dtype=float)
+    if df.empty:
+        raise HTTPError(400, 'no samples')
+    return df.columns, dec.align(df)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep connections alive
+    disable_nagle_algorithm = True  # send small replies right away
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            super().log_message(fmt, *args)
+
+    def reply(self, code, body, content_type='application/json'):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """ GET /atlases: the resident atlases and their columns """
+        if self.path.rstrip('/') != '/atlases':
+            return self.reply(404, json.dumps({'error': 'not found'}))
+        self.reply(200, json.dumps({name: {'features': len(b.dec.features),
+                                           'columns': list(b.dec.columns)}
+                                    for name, b in self.server.batchers.items()}))
+
+    def do_POST(self):
+        """
+        POST /deconvolve/<atlas>: coefficients of the samples in the body,
+        in the same format (csv or json) as the request
+        """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        ctype = self.headers.get('Content-Type', 'application/json')
+        try:
+            parts = self.path.strip('/').split('/')
+            if parts[0] != 'deconvolve' or len(parts) > 2:
+                raise HTTPError(404, 'not found')
+            batchers = self.server.batchers
+            name = parts[1] if len(parts) == 2 else next(iter(batchers))
+            if name not in batchers:
+                raise HTTPError(404, f'unknown atlas: {name}')
+            dec = batchers[name].dec
+            samples, X = parse_samples(body, ctype, dec)
+            Y = batchers[name].submit(X)
+        except HTTPError as e:
+            return self.reply(e.code, json.dumps({'error': str(e)}))
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, json.dumps({'error': str(e)}))
+
+        if ctype.startswith('text/csv'):
+            coef = pd.DataFrame(Y, index=dec.columns, columns=samples)
+            return self.reply(200, coef.to_csv(float_format='%.5f'), ctype)
+        self.reply(200, json.dumps({'columns': list(dec.columns),
+                                    'samples': dict(zip(samples, Y.T.tolist()))}))
+
+
+class UnixHandler(Handler):
+    disable_nagle_algorithm = False  # not a TCP socket
+
+    def address_string(self):
+        return 'unix'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#############################################################
+#                                                           #
+#             Main                                          #
+#                                                           #
+#############################################################
+
+
+def load_atlases(args):
+    cache = TableCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+    batchers = {}
+    for spec in args.atlas:
+        name, path = spec.split('=', 1) if '=' in spec else \
+            (op.splitext(op.basename(spec))[0], spec)
+        dec = Deconvolver(load_table(path, cache=cache), args.beta,
+                          not args.no_norm_weights)
+        batchers[name] = Batcher(dec, args.max_batch, args.max_wait / 1000)
+        eprint(f'loaded atlas {name}: {len(dec.features)} features, '
+               f'{len(dec.columns)} columns')
+    return batchers
+
+
+def main():
+    args = parse_args()
+    batchers = load_atlases(args)
+    if args.socket:
+        if op.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, UnixHandler)
+        eprint(f'listening on {args.socket}')
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        server.daemon_threads = True
+        eprint(f'listening on http://{args.host}:{args.port}')
+    server.batchers = batchers
+    server.verbose = args.verbose
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Deconvolution service: keep atlases in memory and '
+                    'deconvolve samples posted to /deconvolve/<atlas>')
+    parser.add_argument('--atlas', '-a', action='append', required=True,
+                        help='[name=]path of an atlas (csv or npz). '
+                             'May be repeated. The name defaults to the file '
+                             'name. All columns are fixed')
+    parser.add_argument('--beta', type=float, default=0.0,
+                        help='L1 regularization on proportions [0.0]')
+    parser.add_argument('--no_norm_weights', action='store_true',
+                        help='Do not normalize the output weights')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on [127.0.0.1]')
+    parser.add_argument('--port', type=int, default=8470,
+                        help='Port to listen on [8470]')
+    parser.add_argument('--socket',
+                        help='Listen on this unix socket instead of a port')
+    parser.add_argument('--max_batch', type=int, default=4096,
+                        help='Max number of samples solved together [4096]')
+    parser.add_argument('--max_wait', type=float, default=0.0,
+                        help='Milliseconds to wait for more requests before '
+                             'solving a batch. Default is 0: batch only '
+                             'requests that arrived during the previous solve')
+    parser.add_argument('--cache_dir', default=DEF_CACHE_DIR,
+                        help='Cache of parsed tables, as in ssNMF.py')
+    parser.add_argument('--cache_size', type=float, default=DEF_CACHE_SIZE,
+                        help='Max size of the cache, in GB '
+                             f'[{DEF_CACHE_SIZE}]')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
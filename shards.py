@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Client
+
+from algorithm import fcnnls, ITERATIVE_UPDATES, update_columns, \
+    update_gram, error_objective, converged, _project, _exact_project, _dot64, \
+    _gram, _sqnorm, _float_dtype
+from profiler import prof
+from utils_nmf import eprint, load_table, table_values, TableCache, DTYPES, \
+    DEF_CACHE_DIR, DEF_CACHE_SIZE
+
+# the shared secret of the coordinator and remote workers
+AUTHKEY_ENV = 'SSNMF_AUTHKEY'
+
+#############################################################
+#                                                           #
+#             Worker: a shard of the samples                #
+#                                                           #
+#############################################################
+
+
+def parse_address(address):
+    """ host:port (TCP), or the path of a unix socket """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def load_shard(paths, part=0, nr_parts=1, norm_data=False, dtype=float,
+               cache=None):
+    """
+    The samples of a worker: the data tables of paths, side by side, and
+    of them the part-th of nr_parts equal ranges of columns
+    """
+    sfs = [load_table(p, norm_data, cache, dtype) for p in paths]
+    sf = sfs[0] if len(sfs) == 1 else pd.concat(sfs, axis=1)
+    cols = np.array_split(np.arange(sf.shape[1]), nr_parts)[part]
+    return sf if len(cols) == sf.shape[1] else sf.iloc[:, cols]
+
+
+def _align(sf, features):
+    if sf.shape[0] == len(features) and (sf.index == features).all():
+        return table_values(sf)
+    sf = sf.reindex(features)
+    if sf.isnull().values.any():
+        raise ValueError('data has features missing from the atlas')
+    return table_values(sf)
+
+
+def serve_shard(conn, sf, name):
+    """
+    Answer the requests of a coordinator (see run_sharded) on the samples
+    of sf, until it closes the connection. Per iteration, the Y-step of the
+    shard is solved, and only the statistics YY', XYo' and <Af'X, Yf> are
+    sent back. Errors are sent back as exceptions.
+    """
+    conn.send((name, sf.index, sf.columns))
+    X = Y = Y0 = AtX = None
+    while True:
+        try:
+            cmd, *msg = conn.recv()
+        except EOFError:
+            break
+        try:
+            if cmd == 'setup':
+                features, Af, nr_opt, beta, normalize, solver, warm_start = msg
+                X = _align(sf, features)
+                nr_fixed = Af.shape[1]
+                dtype = _float_dtype(X)
+                AtX = np.empty((nr_fixed + nr_opt, X.shape[1]))
+                AtX[:nr_fixed] = _exact_project(Af, X)
+                if solver != 'anls':
+                    Y = np.full(AtX.shape, 1 / AtX.shape[0], dtype=dtype)
+                conn.send((X.shape[1], _sqnorm(X)))
+            elif cmd == 'step':
+                Ao, AtA = msg
+                AtX[nr_fixed:] = _project(Ao, X)
+                if solver == 'anls':
+                    Y = fcnnls(AtA + beta, AtX, Y0)
+                else:
+                    Y = ITERATIVE_UPDATES[solver](AtA + beta, AtX, Y)
+                if normalize:
+                    Y /= Y.sum(axis=0)
+                Y = Y.astype(dtype, copy=False)
+                if warm_start and solver == 'anls':
+                    Y0 = Y
+                Yf, Yo = Y[:nr_fixed], Y[nr_fixed:]
+                conn.send((np.matmul(Y, Y.T, dtype=float),
+                           _dot64(X, Yo.T),
+                           np.einsum('ij,ij->', AtX[:nr_fixed], Yf, dtype=float)))
+            elif cmd == 'coef':
+                conn.send(Y)
+        except Exception as e:
+            conn.send(e)
+    conn.close()
+
+
+def run_worker(address, authkey, paths, name, part=0, nr_parts=1,
+               norm_data=False, dtype=float, cache_dir=None,
+               cache_size=DEF_CACHE_SIZE):
+    """
+    load a shard and serve it to the coordinator at address. The
+    coordinator orders the workers (and their samples) by name
+    """
+    cache = None if cache_dir is None else TableCache(cache_dir, cache_size)
+    conn = Client(address, authkey=authkey)
+    try:
+        sf = load_shard(paths, part, nr_parts, norm_data, dtype, cache)
+    except (Exception, SystemExit) as e:
+        # load_table exits on invalid files
+        msg = e if isinstance(e, Exception) else 'invalid table'
+        conn.send(ValueError(f'{", ".join(paths)}: {msg}'))
+        conn.close()
+        return
+    serve_shard(conn, sf, name)
+
+#############################################################
+#                                                           #
+#             Coordinator                                   #
+#                                                           #
+#############################################################
+
+
+def spawn_workers(address, authkey, paths, nr_workers, norm_data=False,
+                  dtype=float, cache_dir=None, cache_size=DEF_CACHE_SIZE):
+    """
+    Start nr_workers local worker processes, connecting to address. With
+    one data file, worker i owns the i-th range of its columns. With
+    several, it owns the i-th range of the files
+    """
+    procs = []
+    for i in range(nr_workers):
+        if len(paths) > 1:
+            shard = [list(f) for f in np.array_split(paths, nr_workers)][i]
+            part, nr_parts = 0, 1
+        else:
+            shard, part, nr_parts = paths, i, nr_workers
+        proc = Process(target=run_worker, daemon=True,
+                       args=(address, authkey, shard, i, part, nr_parts,
+                             norm_data, dtype, cache_dir, cache_size))
+        proc.start()
+        procs.append(proc)
+    return procs
+
+
+def accept_workers(listener, nr_workers):
+    """
+    Wait for nr_workers workers to connect.
+    :return: their connections and their (name, features, samples),
+             ordered by name, then by first sample name, so that the
+             order does not depend on which worker connects first
+    """
+    workers = []
+    while len(workers) < nr_workers:
+        try:
+            conn = listener.accept()
+        except AuthenticationError:
+            eprint('Warning: rejected a worker with a wrong secret')
+            continue
+        workers.append((_recv(conn), conn))
+    def key(worker):
+        name, _, samples = worker[0]
+        return name, str(samples[0]) if len(samples) else ''
+    workers.sort(key=key)
+    return [conn for _, conn in workers], [hello for hello, _ in workers]
+
+
+def _recv(conn):
+    msg = conn.recv()
+    if isinstance(msg, Exception):
+        raise msg
+    return msg
+
+
+def _gather(conns, msg):
+    """ send msg to all workers (which then work concurrently), and
+    return their replies """
+    for conn in conns:
+        conn.send(msg)
+    return [_recv(conn) for conn in conns]
+
+
+def run_sharded(conns, features, A, fixed, beta, eta, n_iter, normalize,
+                solver='anls', tol=0.0, patience=1, warm_start=False,
+                pool=None):
+    """
+    run_deconvolution, with the samples split among workers (see
+    serve_shard). The Y-step is independent per sample, so every worker
+    solves the coefficients of its own samples. The A-step only needs
+    YY' and XYo' summed over the samples, which the workers compute on
+    their shards. Per iteration, the coordinator sends the learned columns
+    Ao and A'A, and receives these sums, of size (nr_ref_samp, nr_ref_samp)
+    and (nr_feat, nr_opt). The data never leaves the workers.
+    :param conns: connections to the workers
+    :param features: the atlas features. Workers reorder their data by them
+    :param pool: a parallel.NNLSPool to solve the A-step on
+    Other parameters are as in run_deconvolution (with the fcnnls engine).
+    :return: the atlas, the mixture coefficients (of the workers, in the
+             order of conns) and the RMSE per iteration
+    """
+    nr_features, nr_ref_samp = A.shape
+    # fixed columns first, as in run_deconvolution
+    order = np.argsort(fixed == 0, kind='stable')
+    nr_fixed = int(np.sum(fixed != 0))
+    nr_opt = nr_ref_samp - nr_fixed
+    if sparse.issparse(A) and nr_opt:
+        A = A.toarray()
+    A = A[:, order]
+    Af, Ao = A[:, :nr_fixed], A[:, nr_fixed:]
+    shards = _gather(conns, ('setup', features, Af, nr_opt, beta, normalize,
+                             solver, warm_start))
+    nr_samples = sum(n for n, _ in shards)
+    sqnorm_X = sum(sqnorm for _, sqnorm in shards)
+    AtA = _gram(A)
+
+    def rmse(sq_error):
+        return np.sqrt(sq_error / (nr_features * nr_samples))
+
+    history = []
+    prev_obj, stalled = None, 0
+    for it in range(n_iter if nr_opt else 1):
+        prof.start_iteration()
+        stats = _gather(conns, ('step', Ao, AtA))
+        YYt = sum(s[0] for s in stats)
+        XYo = sum(s[1] for s in stats)
+        AfXYf = sum(s[2] for s in stats)
+        prof.lap('y_step')
+
+        # the A-step, as in run_deconvolution
+        if nr_opt:
+            update_columns(Ao, Af, YYt, XYo, eta, solver,
+                           solve = fcnnls if pool is None else pool.fcnnls,
+                           init  = Ao.T if warm_start and it else None)
+            update_gram(AtA, A, nr_fixed)
+            prof.lap('a_step')
+
+        sq_error, obj = error_objective(sqnorm_X, AfXYf, Ao, XYo, AtA, YYt,
+                                        beta, eta)
+        history.append(rmse(sq_error))
+        prof.lap('error')
+        prof.end_iteration(objective=obj, rmse=history[-1])
+        done, stalled = converged(prev_obj, obj, tol, patience, stalled)
+        if done:
+            break
+        prev_obj = obj
+
+    Y = np.hstack(_gather(conns, ('coef',)))
+    inv = np.argsort(order)
+    return A[:, inv], Y[inv], history
+
+#############################################################
+#                                                           #
+#             Main (remote worker)                          #
+#                                                           #
+#############################################################
+
+
+def authkey():
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        eprint(f'Error: set ${AUTHKEY_ENV} to the same secret on the '
+               'coordinator and the workers')
+        exit(1)
+    return key.encode()
+
+
+def main():
+    args = parse_args()
+    address = parse_address(args.connect)
+    eprint(f'serving {len(args.data)} data files to {args.connect}')
+    try:
+        # remote workers are named by their data files
+        run_worker(address, authkey(), args.data, ' '.join(args.data),
+                   norm_data=args.norm_data, dtype=args.dtype,
+                   cache_dir=args.cache_dir, cache_size=args.cache_size)
+    except (OSError, AuthenticationError) as e:
+        eprint(f'Error: cannot connect to {args.connect}: {e}')
+        exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='A worker of a sharded ssNMF.py run (--workers, '
+                    '--listen): owns the samples of its data files, and '
+                    'serves their coefficients and statistics to the '
+                    f'coordinator. The secret is read from ${AUTHKEY_ENV}')
+    parser.add_argument('--connect', '-c', required=True,
+                        help='Address of the coordinator (its --listen): '
+                             'host:port or a unix socket path')
+    parser.add_argument('--data', '-i', required=True, nargs='+',
+                        help='The data tables of this worker (side by side)')
+    parser.add_argument('--norm_data', action='store_true',
+                        help='normalize each sample to sum up to one')
+    parser.add_argument('--dtype', choices=DTYPES, default=DTYPES[0])
+    parser.add_argument('--cache_dir', default=DEF_CACHE_DIR,
+                        help='Directory for a cache of parsed input tables '
+                             '(see ssNMF.py)')
+    parser.add_argument('--cache_size', type=float, default=DEF_CACHE_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,26 @@
 
 import pandas as pd
 import numpy as np
+import os
 import argparse
-
-from utils_nmf import eprint, validate_file, load_table, \
-    parse_cut_str, mkdir_p, dump_df
-from algorithm import run_deconvolution
+from scipy import sparse
+from contextlib import nullcontext
+
+from multiprocessing import Pool
+from multiprocessing.connection import Listener
+
+from utils_nmf import eprint, validate_file, load_table, file_stems, \
+    parse_cut_str, mkdir_p, dump_df, iter_table, SEP, TableCache, \
+    table_values, FORMAT_EXTS, save_checkpoint, load_checkpoint, \
+    remove_files, ResultCache
+from algorithm import run_deconvolution, run_nnls, run_nnls_stream, \
+    run_online, nndsvd, sample_sq_errors, select_markers, refit_columns, \
+    _project
+from deconvolver import Deconvolver
+from parallel import NNLSPool, run_restarts, run_bootstrap
+from shards import run_sharded, spawn_workers, accept_workers, authkey, \
+    parse_address
+from profiler import prof, profiled
 from parse_arguments import parse_args, validate_args
 
 
@@ -17,7 +32,7 @@ from parse_arguments import parse_args, validate_args
 #############################################################
 
 def init_column(args, i, N):
-    # TODO: use args for smarter initialization (e.g. beta distribution)
+    # random initialization. See data_init for --init
     vals = np.random.normal(loc=.75, scale=.5, size=N)
     return f'Unknown.{i + 1}', np.clip(vals, 0, 1)
 
@@ -30,12 +45,18 @@ def gen_NMF_atlas(args, features):
     return df
 
 
+def table_cache(args):
+    if args.cache_dir is None:
+        return None
+    return TableCache(args.cache_dir, args.cache_size)
+
+
 def load_atlas(args, features):
     if args.atlas is None:
         return gen_NMF_atlas(args, features)
 
     # load atlas
-    df = load_table(args.atlas)
+    df = load_table(args.atlas, cache=table_cache(args), dtype=args.dtype)
     # append dummy columns:
     for i in range(args.add):
         name, vals = init_column(args, i, df.shape[0])
@@ -45,6 +66,48 @@ def load_atlas(args, features):
         df[name] = vals
     return df
 
+
+def restart_atlases(args, atlas, seeds):
+    """
+    Yield an initial atlas per seed. The unknown columns are drawn
+    exactly as in a single run with --seed <seed>
+    """
+    for seed in seeds:
+        np.random.seed(seed)
+        for i in range(args.nmf_cols or args.add):
+            name, vals = init_column(args, i, atlas.shape[0])
+            atlas[name] = vals
+        yield table_values(atlas).copy()
+
+
+def data_init(args, atlas, X):
+    """
+    Replace the random unknown columns of the atlas (--nmf_cols / --add)
+    with a deterministic, data driven initialization (--init):
+        nndsvd:   NNDSVD of the data
+        nndsvda:  same, with zeros replaced by the data mean
+        residual: nndsvda of the residual of the data after an NNLS fit
+                  on the other atlas columns
+    Columns are scaled to the mean of the data.
+    """
+    k = args.nmf_cols or args.add
+    if args.init == 'random' or not k:
+        return atlas
+    known = table_values(atlas.iloc[:, :atlas.shape[1] - k])
+    mean = X.mean()
+    if args.init == 'residual' and known.shape[1]:
+        Y = run_nnls(known, X, args.beta, not args.no_norm_weights)
+        X = np.asarray(X - known @ Y)
+    W = nndsvd(X, k)
+    W *= mean / np.maximum(W.mean(axis=0), 1e-16)
+    if args.init != 'nndsvd':
+        W[W == 0] = mean
+
+    atlas = atlas.copy()
+    for i in range(k):
+        atlas[f'Unknown.{i + 1}'] = W[:, i]
+    return atlas
+
 #############################################################
 #                                                           #
 #             Parsing input                                 #
@@ -60,6 +123,7 @@ def print_col_status(ocols, d):
         print()
 
 
+@profiled('parse_cols')
 def parse_cols(orig_atlas, args):
     """
     parse user input argument regrding the columns of
@@ -105,6 +169,53 @@ def parse_cols(orig_atlas, args):
 
     return atlas, np.array(bv)
 
+#############################################################
+#                                                           #
+#             Marker features                               #
+#                                                           #
+#############################################################
+
+def marker_features(args, atlas):
+    """
+    The features to deconvolve on (--markers, --feature_index), as indices
+    of the atlas rows. Markers are scored on the atlas columns given as
+    input, not the added ones. A new selection is saved to
+    <prefix>.markers.csv, to be reused with --feature_index
+    """
+    if args.feature_index:
+        names = pd.read_csv(args.feature_index, sep=SEP).iloc[:, 0]
+        idx = np.flatnonzero(atlas.index.isin(names))
+        if not len(idx):
+            eprint(f'Error: none of the features of {args.feature_index} '
+                   'are in the atlas')
+            exit(1)
+        if len(idx) < len(names):
+            eprint(f'Warning: {len(names) - len(idx)} features of '
+                   f'{args.feature_index} are not in the atlas')
+        return idx
+
+    known = table_values(atlas.iloc[:, :atlas.shape[1] - args.add])
+    idx = select_markers(known, args.markers, args.marker_score)
+    path = args.prefix + '.markers.csv'
+    pd.Series(atlas.index[idx], name=atlas.index.name or 'feature').to_csv(
+        path, sep=SEP, index=False)
+    eprint(f'dumped {path}')
+    return idx
+
+
+def project_back(args, atlas, sf, Y, fixed_bv, pool):
+    """
+    Extend an atlas learned on the marker features to all features
+    (--project_back): the fixed columns are those of the input atlas, and
+    the others are fitted to the data of all features, given the
+    coefficients.
+    :return: the atlas and the RMSE on all features
+    """
+    X = table_values(sf)
+    A = refit_columns(table_values(atlas), X, Y, fixed_bv, args.eta, pool)
+    sq_error = sample_sq_errors(A, X, Y).sum()
+    return A, np.sqrt(sq_error / (X.shape[0] * X.shape[1]))
+
 #############################################################
 #                                                           #
 #             Main                                          #
@@ -112,42 +223,467 @@ def parse_cols(orig_atlas, args):
 #############################################################
 
 
-def main():
-    args = parse_args()
-    validate_args(args)
+def stream_blocks(args, atlas):
+    """
+    Read the data table in chunks of rows, and yield them as numpy
+    arrays with the matching rows of the atlas.
+    """
+    nr_features = 0
+    for df in iter_table(args.data, args.chunk_size):
+        block = atlas.reindex(df.index)
+        if block.isnull().values.any():
+            eprint(f'Error: {args.data} has features missing from the atlas')
+            exit(1)
+        nr_features += df.shape[0]
+        yield block.values, df.values
+    if nr_features != atlas.shape[0]:
+        eprint(f'Error: atlas has features missing from {args.data}')
+        exit(1)
+
+
+def stream_main(args, pool):
+    """
+    Deconvolve a data table too large to load, with a fixed atlas
+    """
+    atlas, fixed_bv = parse_cols(load_atlas(args, None), args)
+    if not fixed_bv.all():
+        eprint('Invalid input: --stream requires all atlas columns to be fixed')
+        exit(1)
+    samples = pd.read_csv(args.data, sep=SEP, index_col=0, nrows=0).columns
+
+    Y, rmse = run_nnls_stream(blocks    = stream_blocks(args, atlas),
+                              beta      = args.beta,
+                              normalize = not args.no_norm_weights,
+                              norm_cols = args.norm_data,
+                              pool      = pool)
+    coef = pd.DataFrame(columns=samples, index=atlas.columns, data=Y)
+    return atlas, coef, [rmse], fixed_bv
+
+
+def restarts_main(args, atlas0, X, fixed_bv, kwargs):
+    """
+    Run --restarts differently seeded factorizations, and return the best
+    one. Restart i is seeded with --seed + i (or a random seed + i).
+    Dump a summary of all restarts.
+    """
+    base = args.seed if args.seed else np.random.randint(1, 2 ** 31 - args.restarts)
+    seeds = [base + i for i in range(args.restarts)]
+    (best, A, Y, history), summary = run_restarts(
+        inits   = list(restart_atlases(args, atlas0, seeds)),
+        X       = X,
+        fixed   = fixed_bv,
+        threads = args.threads,
+        margin  = args.restart_margin,
+        **kwargs)
+
+    df = pd.DataFrame(summary, columns=['objective', 'iterations', 'abandoned'])
+    df.insert(0, 'seed', seeds)
+    df.index.name = 'restart'
+    df['best'] = df.index == best
+    if args.verbose:
+        eprint(df.to_string())
+    eprint(f'Best restart: {best + 1}/{args.restarts} (seed {seeds[best]}), '
+           f'{df.abandoned.sum()} abandoned')
+    df.to_csv(args.prefix + '.restarts.csv', sep=SEP)
+    return A, Y, history
 
-    if args.seed:
-        np.random.seed(args.seed)
 
+def bootstrap_main(args, A, X, coef):
+    """
+    Bootstrap the coefficients on the resulting atlas A (--bootstrap),
+    and dump the mean, sd and quantiles of each coefficient
+    """
+    seed = args.seed if args.seed else None
+    Y = run_bootstrap(A             = A,
+                      X             = X,
+                      nr_replicates = args.bootstrap,
+                      beta          = args.beta,
+                      normalize     = not args.no_norm_weights,
+                      seed          = seed,
+                      threads       = args.threads,
+                      groups        = args.bootstrap_groups)
+    stats = {'mean': Y.mean(axis=0), 'sd': Y.std(axis=0, ddof=1)}
+    for q in args.quantiles:
+        stats[f'q{q:g}'] = np.quantile(Y, q, axis=0)
+    ext = FORMAT_EXTS[args.out_format]
+    for name, vals in stats.items():
+        df = pd.DataFrame(vals, index=coef.index, columns=coef.columns)
+        dump_df(f'{args.prefix}.coef.{name}.{ext}', df, threads=args.threads)
+
+
+def result_context(args, A, features, columns):
+    """
+    What the coefficients of a sample depend on, besides its values, for
+    the result cache (--result_cache): the atlas, --beta and the
+    normalization. The NNLS solution does not depend on the engine
+    (up to rounding)
+    """
+    return ResultCache.context(A, features, columns, args.beta,
+                               not args.no_norm_weights)
+
+
+def solve_cached(cache, context, X, nr_cols, solve):
+    """
+    Solve only the samples (columns of X) missing from the result cache,
+    with solve(X) -> (coefficients, squared error per sample). Take the
+    others from the cache, and add the new ones to it.
+    :return: the coefficients, the squared error per sample and the
+             number of samples found in the cache
+    """
+    keys = cache.keys(context, X)
+    found = cache.get(keys)
+    miss = np.array([k not in found for k in keys], dtype=bool)
+    Y = np.empty((nr_cols, X.shape[1]))
+    sq_errors = np.empty(X.shape[1])
+    for j in np.flatnonzero(~miss):
+        Y[:, j], sq_errors[j] = found[keys[j]]
+    if miss.any():
+        Y[:, miss], sq_errors[miss] = solve(X[:, miss])
+        cache.put([keys[j] for j in np.flatnonzero(miss)], Y[:, miss],
+                  sq_errors[miss])
+    return Y, sq_errors, int(np.sum(~miss))
+
+
+def cached_main(args, atlas, X, pool):
+    """
+    NNLS of the data on a fixed atlas, through the result cache
+    (--result_cache): only new or changed samples are solved
+    """
+    A = table_values(atlas)
+    normalize = not args.no_norm_weights
+
+    def solve(X):
+        Y = run_nnls(A, X, args.beta, normalize, args.nnls_engine, pool)
+        return Y, sample_sq_errors(A, X, Y)
+
+    Y, sq_errors, hits = solve_cached(
+        ResultCache(args.result_cache),
+        result_context(args, A, atlas.index, atlas.columns),
+        X, A.shape[1], solve)
+    eprint(f'Result cache: {hits} hits, {X.shape[1] - hits} misses')
+    rmse = np.sqrt(sq_errors.sum() / (X.shape[0] * X.shape[1]))
+    return A, Y.astype(X.dtype, copy=False), [rmse]
+
+
+# the prepared atlas and the result cache, shared by all data files of a
+# process
+_multi = {}
+
+
+def _init_multi(args, dec, context):
+    cache = ResultCache(args.result_cache) if args.result_cache else None
+    _multi.update(args=args, dec=dec, cache=cache, context=context)
+
+
+def _deconvolve_file(task):
+    path, stem = task
+    args, dec, cache = _multi['args'], _multi['dec'], _multi['cache']
+    sf = load_table(path, args.norm_data, table_cache(args), args.dtype)
+    try:
+        X = dec.align(sf)
+    except ValueError as e:
+        raise ValueError(f'{path}: {e}')
+
+    def solve(X):
+        Y = dec.solve(_project(dec.A, X))
+        return Y, sample_sq_errors(dec.A, X, Y)
+
+    if cache is None:
+        (Y, sq_errors), hits = solve(X), 0
+    else:
+        Y, sq_errors, hits = solve_cached(cache, _multi['context'], X,
+                                          len(dec.columns), solve)
+    coef = pd.DataFrame(Y, index=dec.columns, columns=sf.columns)
+    ext = FORMAT_EXTS[args.out_format]
+    dump_df(f'{args.prefix}.{stem}.coef.{ext}', coef,
+            verbose=args.verbose)
+    rmse = np.sqrt(sq_errors.sum() / (X.shape[0] * X.shape[1]))
+    return path, coef, rmse, hits
+
+
+def multi_main(args, pool):
+    """
+    Deconvolve several data files on the same atlas, whose columns are all
+    fixed. The atlas is loaded and prepared (see Deconvolver) once, and the
+    files are deconvolved concurrently, on --threads processes. Files whose
+    features are in another order are reindexed.
+    Dump the coefficients of each file and a summary of the files, and
+    return the coefficients of all of them
+    """
+    atlas, fixed_bv = parse_cols(load_atlas(args, None), args)
+    if not fixed_bv.all():
+        eprint('Invalid input: several data files require all atlas '
+               'columns to be fixed')
+        exit(1)
+    full = atlas
+    if args.markers or args.feature_index:
+        atlas = atlas.iloc[marker_features(args, atlas)]
+    dec = Deconvolver(atlas, args.beta, not args.no_norm_weights)
+    initargs = (args, dec, result_context(args, dec.A, dec.features,
+                                          dec.columns))
+
+    # unique per file (see validate_args)
+    stems = file_stems(args.data_files)
+    tasks = list(zip(args.data_files, stems))
+    threads = min(args.threads, len(args.data_files))
+    if threads > 1:
+        workers = Pool(threads, _init_multi, initargs)
+        results = workers.imap(_deconvolve_file, tasks)
+    else:
+        workers = None
+        _init_multi(*initargs)
+        results = map(_deconvolve_file, tasks)
+    try:
+        results = list(results)
+    except ValueError as e:
+        eprint(f'Error: {e}')
+        exit(1)
+    finally:
+        if workers is not None:
+            workers.close()
+            workers.join()
+
+    df = pd.DataFrame([(path, coef.shape[1], rmse, hits)
+                       for path, coef, rmse, hits in results],
+                      columns=['file', 'samples', 'rmse', 'cache_hits'])
+    if not args.result_cache:
+        df.drop(columns='cache_hits', inplace=True)
+    df.to_csv(args.prefix + '.files.csv', sep=SEP, index=False)
+    coef = pd.concat([c for _, c, _, _ in results], axis=1)
+    if coef.columns.duplicated().any():
+        eprint('Warning: sample names repeat across data files. '
+               'Prefixing them with the file names')
+        coef.columns = [f'{stem}:{s}' for stem, (_, c, _, _) in
+                        zip(stems, results) for s in c.columns]
+    rmse = np.sqrt(np.sum(df.rmse ** 2 * df.samples) / df.samples.sum())
+    eprint(f'Deconvolved {len(df)} files, {coef.shape[1]} samples')
+    if args.result_cache:
+        hits = df.cache_hits.sum()
+        eprint(f'Result cache: {hits} hits, {coef.shape[1] - hits} misses')
+    # the fixed atlas on all features is the input one
+    return full if args.project_back else atlas, coef, [rmse], fixed_bv
+
+
+def shards_main(args, pool):
+    """
+    Factorize with the samples split among --workers worker processes (see
+    run_sharded). By default, the workers are started locally, and each
+    loads a range of the columns of the data (or of the data files). With
+    --listen, remote workers (shards.py) connect, each with its own data
+    files.
+    """
+    if args.listen:
+        listener = Listener(parse_address(args.listen), authkey=authkey())
+        eprint(f'waiting for {args.workers} workers on {args.listen}')
+    else:
+        key = os.urandom(16)
+        listener = Listener(family='AF_UNIX', authkey=key)
+        spawn_workers(listener.address, key, args.data_files, args.workers,
+                      args.norm_data, args.dtype, args.cache_dir,
+                      args.cache_size)
+    try:
+        conns, shards = accept_workers(listener, args.workers)
+    except (ValueError, EOFError) as e:
+        eprint(f'Error: a worker failed to load its data: {e}')
+        exit(1)
+    finally:
+        listener.close()
+    samples = [s for _, _, cols in shards for s in cols]
+    eprint(f'{len(conns)} workers, {len(samples)} samples')
+
+    atlas0, fixed_bv = parse_cols(load_atlas(args, shards[0][1]), args)
+    if args.markers or args.feature_index:
+        atlas0 = atlas0.iloc[marker_features(args, atlas0)]
+    try:
+        A, Y, history = run_sharded(
+            conns      = conns,
+            features   = atlas0.index,
+            A          = table_values(atlas0).copy(),
+            fixed      = fixed_bv,
+            beta       = args.beta,
+            eta        = args.eta,
+            n_iter     = args.n_iter,
+            normalize  = not args.no_norm_weights,
+            solver     = args.solver,
+            tol        = args.tol,
+            patience   = args.patience,
+            warm_start = not args.no_warm_start,
+            pool       = pool)
+    except (ValueError, EOFError, ConnectionError) as e:
+        eprint(f'Error: worker failed: {e}')
+        exit(1)
+    finally:
+        for conn in conns:
+            conn.close()
+
+    coef = pd.DataFrame(Y, index=atlas0.columns, columns=samples)
+    if coef.columns.duplicated().any():
+        eprint('Warning: sample names repeat across workers')
+    if sparse.issparse(A):
+        atlas = pd.DataFrame.sparse.from_spmatrix(A, index=atlas0.index,
+                                                  columns=atlas0.columns)
+    else:
+        atlas = pd.DataFrame(A, index=atlas0.index, columns=atlas0.columns)
+    return atlas, coef, history, fixed_bv
+
+
+def align_data(args, sf, atlas):
+    """
+    Order the data rows as the atlas features. Tables whose features
+    are in a different order are reindexed
+    """
+    if sf.shape[0] == atlas.shape[0] and (sf.index == atlas.index).all():
+        return sf
+    if sf.shape[0] != atlas.shape[0] or not sf.index.isin(atlas.index).all():
+        eprint(f'Error: {args.data} and the atlas have different features')
+        exit(1)
+    return sf.reindex(atlas.index)
+
+
+def checkpoint_meta(args, atlas, fixed_bv, X):
+    """
+    What a checkpoint must match to be resumed: the parsed columns, the
+    data shape and the arguments that affect the results
+    """
+    opts = ('data', 'atlas', 'beta', 'eta', 'solver', 'nnls_engine', 'tol',
+            'patience', 'no_warm_start', 'norm_data', 'no_norm_weights',
+            'dtype', 'markers', 'marker_score', 'feature_index')
+    return {'columns': [str(c) for c in atlas.columns],
+            'fixed': [int(f) for f in fixed_bv],
+            'shape': list(X.shape),
+            'args': {k: getattr(args, k) for k in opts}}
+
+
+def checkpointing(args, atlas, fixed_bv, X):
+    """
+    The checkpoint and resume arguments of run_deconvolution
+    (--checkpoint_every, --resume)
+    """
+    path = args.prefix + '.checkpoint.npz'
+    meta = checkpoint_meta(args, atlas, fixed_bv, X)
+    resume = None
+    if args.resume:
+        resume, saved = load_checkpoint(path)
+        if saved != meta:
+            eprint(f'Error: {path} was saved by a run with different '
+                   'arguments or inputs')
+            exit(1)
+        eprint(f'Resuming from iteration {resume["it"] + 1}')
+    checkpoint = None
+    if args.checkpoint_every:
+        checkpoint = lambda state: save_checkpoint(path, state, meta)
+    return dict(checkpoint       = checkpoint,
+                checkpoint_every = max(args.checkpoint_every, 1),
+                resume           = resume)
+
+
+def deconvolve_main(args, pool):
     # load samples table:
-    sf = load_table(args.data, args.norm_data)
+    sf = load_table(args.data, args.norm_data, table_cache(args), args.dtype)
     features = sf.index.tolist()
 
     # load atlas:
     orig_atlas = load_atlas(args, features)
     atlas0, fixed_bv = parse_cols(orig_atlas, args)
 
-    # make sure atlas and data have the exact same features (rows)
-    assert (sf.index != atlas0.index).sum() == 0
+    # atlas and data must have the same features (rows), in the same order
+    sf = align_data(args, sf, atlas0)
+    full = None
+    if args.markers or args.feature_index:
+        idx = marker_features(args, atlas0)
+        eprint(f'Deconvolving on {len(idx)} of {sf.shape[0]} features')
+        full = atlas0, sf
+        atlas0, sf = atlas0.iloc[idx], sf.iloc[idx]
+    atlas0 = data_init(args, atlas0, table_values(sf))
 
     # deconvolve samples:
-    A, Y, history = run_deconvolution(A         = atlas0.copy().values,
-                                      X         = sf.copy().values,
-                                      fixed     = fixed_bv,
-                                      beta      = args.beta,
-                                      eta       = args.eta,
-                                      n_iter    = args.n_iter,
-                                      normalize = not args.no_norm_weights)
+    kwargs = dict(beta       = args.beta,
+                  eta        = args.eta,
+                  n_iter     = args.n_iter,
+                  normalize  = not args.no_norm_weights,
+                  engine     = args.nnls_engine,
+                  solver     = args.solver,
+                  tol        = args.tol,
+                  patience   = args.patience,
+                  warm_start = not args.no_warm_start)
+    if args.result_cache and not fixed_bv.all():
+        eprint('Invalid input: --result_cache requires all atlas columns '
+               'to be fixed')
+        exit(1)
+    if args.result_cache:
+        A, Y, history = cached_main(args, atlas0, table_values(sf), pool)
+    elif args.restarts > 1:
+        A, Y, history = restarts_main(args, atlas0, table_values(sf),
+                                      fixed_bv, kwargs)
+    elif args.batch_size:
+        del kwargs['engine'], kwargs['warm_start']
+        A, Y, history = run_online(A          = table_values(atlas0).copy(),
+                                   X          = table_values(sf),
+                                   fixed      = fixed_bv,
+                                   batch_size = args.batch_size,
+                                   decay      = args.decay,
+                                   pool       = pool,
+                                   **kwargs)
+    else:
+        if args.checkpoint_every or args.resume:
+            kwargs.update(checkpointing(args, atlas0, fixed_bv, sf))
+        A, Y, history = run_deconvolution(A     = table_values(atlas0).copy(),
+                                          X     = table_values(sf),
+                                          fixed = fixed_bv,
+                                          pool  = pool,
+                                          **kwargs)
 
     coef = pd.DataFrame(columns=sf.columns, index=atlas0.columns, data=Y)
-    atlas = pd.DataFrame(columns=atlas0.columns, index=sf.index, data=A)
+    if args.bootstrap:
+        bootstrap_main(args, A, table_values(sf), coef)
+    if full is not None and args.project_back:
+        eprint(f'RMSE on the {sf.shape[0]} selected features: {history[-1]}')
+        atlas0, sf = full
+        A, rmse = project_back(args, atlas0, sf, Y, fixed_bv, pool)
+        history[-1:] = [rmse]
+    if sparse.issparse(A):
+        atlas = pd.DataFrame.sparse.from_spmatrix(A, index=sf.index,
+                                                  columns=atlas0.columns)
+    else:
+        atlas = pd.DataFrame(columns=atlas0.columns, index=sf.index, data=A)
+    return atlas, coef, history, fixed_bv
+
+
+def main():
+    args = parse_args()
+    validate_args(args)
+
+    if args.profile:
+        prof.enable()
+    if args.seed:
+        np.random.seed(args.seed)
+
+    run = stream_main if args.stream else deconvolve_main
+    if len(args.data_files) > 1:
+        run = multi_main
+    if args.workers:
+        run = shards_main
+    # restarts and data files run on their own processes, each solving
+    # serially. Sharded runs solve the A-step on the pool
+    use_pool = args.threads > 1 and args.restarts == 1 and \
+        (len(args.data_files) == 1 or args.workers)
+    with (NNLSPool(args.threads) if use_pool else nullcontext()) as pool:
+        atlas, coef, history, fixed_bv = run(args, pool)
 
     # calc RMSE
+    if not fixed_bv.all():
+        print(f'Iterations: {len(history)}')
     print(f'RMSE: {history[-1]}\n')
 
     # Dump results
-    dump_df(args.prefix + '.atlas.csv', atlas)
-    dump_df(args.prefix + '.coef.csv', coef)
+    ext = FORMAT_EXTS[args.out_format]
+    dump_df(f'{args.prefix}.atlas.{ext}', atlas, threads=args.threads)
+    dump_df(f'{args.prefix}.coef.{ext}', coef, threads=args.threads)
+    if args.checkpoint_every or args.resume:
+        remove_files([args.prefix + '.checkpoint.npz'])
+    if args.profile:
+        prof.dump(args.prefix + '.profile.json')
+        eprint(f'dumped {args.prefix}.profile.json')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+
+from algorithm import run_deconvolution, run_nnls, _dot, _dense
+from parse_arguments import build_parser, validate_args
+from ssNMF import init_column, gen_NMF_atlas, parse_cols, data_init, \
+    table_cache
+from utils_nmf import eprint, load_table, table_values, SEP
+
+DEF_HOLDOUT = 0.1
+
+#############################################################
+#                                                           #
+#             Grid points                                   #
+#                                                           #
+#############################################################
+
+
+def initial_atlas(args, atlas, k, features, X):
+    """
+    The initial atlas and fixed columns with k unknown columns (--nmf_cols
+    or --add), drawn exactly as by ssNMF.py with the same --seed
+    """
+    args = argparse.Namespace(**vars(args))
+    if args.nmf_cols:
+        args.nmf_cols = k
+    else:
+        args.add = k
+    if args.seed:
+        np.random.seed(args.seed)
+    if atlas is None:
+        atlas = gen_NMF_atlas(args, features)
+    else:
+        atlas = atlas.copy()
+        for i in range(k):
+            name, vals = init_column(args, i, atlas.shape[0])
+            atlas[name] = vals
+    atlas, fixed = parse_cols(atlas, args)
+    atlas = data_init(args, atlas, X)
+    return table_values(atlas), fixed
+
+
+# the training and held-out data, shared by all paths of a process
+_sweep = {}
+
+
+def _init_sweep(X, X_fit, X_eval, train_f, test_f, betas, kwargs):
+    _sweep.update(X=X, X_fit=X_fit, X_eval=X_eval, train_f=train_f,
+                  test_f=test_f, betas=betas, kwargs=kwargs)
+
+
+def heldout_rmse(A, beta, normalize):
+    """
+    Bi-cross-validation error: the held-out samples are deconvolved on the
+    training features, and predicted on the held-out features
+    """
+    if _sweep['X_fit'] is None:
+        return np.nan
+    Y = run_nnls(A[_sweep['train_f']], _sweep['X_fit'], beta, normalize)
+    pred = _dot(A[_sweep['test_f']], Y)
+    return np.sqrt(np.mean((pred - _sweep['X_eval']) ** 2))
+
+
+def _run_path(task):
+    """
+    Walk the beta path of one (k, eta), in increasing order, starting each
+    grid point from the atlas of the previous one
+    """
+    k, eta, A, fixed = task
+    X, kwargs = _sweep['X'], _sweep['kwargs']
+    learned = fixed == 0
+    rows = []
+    for beta in _sweep['betas']:
+        start = time.perf_counter()
+        A, Y, history = run_deconvolution(A, X, fixed, beta, eta, **kwargs)
+        obj = history[-1] ** 2 * X.shape[0] * X.shape[1] + \
+            beta * np.sum(Y.sum(axis=0) ** 2)
+        # the learned columns are dense (see run_deconvolution)
+        Ao = A[:, learned] if learned.any() else np.zeros((0, 0))
+        rows.append({'k': k, 'beta': beta, 'eta': eta,
+                     'iterations': len(history),
+                     'rmse': history[-1],
+                     'objective': obj + eta * np.sum(Ao ** 2),
+                     'coef_sparsity': np.mean(Y == 0),
+                     'atlas_sparsity': np.mean(Ao == 0) if Ao.size else np.nan,
+                     'heldout_rmse': heldout_rmse(A, beta, kwargs['normalize']),
+                     'seconds': time.perf_counter() - start})
+    return rows
+
+#############################################################
+#                                                           #
+#             Main                                          #
+#                                                           #
+#############################################################
+
+
+def split(args, sf):
+    """
+    Random held-out samples and features (--holdout). The factorization
+    is fit on the other samples (all features)
+    :return: the training data, the held-out data on the training and on
+             the held-out features (None if no hold out), and the training
+             and held-out feature indices
+    """
+    nr_features, nr_samples = sf.shape
+    rng = np.random.default_rng(args.seed)
+    nr_test = int(round(args.holdout * nr_samples))
+    if not nr_test:
+        return sf, None, None, None, None
+    test_s = np.sort(rng.choice(nr_samples, nr_test, replace=False))
+    test_f = np.sort(rng.choice(nr_features, max(int(round(
+        args.holdout * nr_features)), 1), replace=False))
+    train_s = np.setdiff1d(np.arange(nr_samples), test_s)
+    train_f = np.setdiff1d(np.arange(nr_features), test_f)
+    return sf.iloc[:, train_s], table_values(sf.iloc[train_f, test_s]), \
+        _dense(table_values(sf.iloc[test_f, test_s])), train_f, test_f
+
+
+def main():
+    args = parse_args()
+    validate_args(args)
+    if len(args.data_files) != 1 or args.workers:
+        eprint('Invalid input: sweep.py takes a single data file, and no '
+               '--workers')
+        exit(1)
+    if args.markers or args.feature_index:
+        eprint('Invalid input: sweep.py does not select features '
+               '(--markers, --feature_index)')
+        exit(1)
+
+    sf = load_table(args.data, args.norm_data, table_cache(args), args.dtype)
+    atlas = None
+    if args.atlas is not None:
+        atlas = load_table(args.atlas, cache=table_cache(args),
+                           dtype=args.dtype)
+        if (sf.index != atlas.index).any():
+            eprint(f'Error: {args.atlas} and {args.data} have different features')
+            exit(1)
+    train, X_fit, X_eval, train_f, test_f = split(args, sf)
+    X = table_values(train)
+
+    ks = args.ks or [args.nmf_cols or args.add]
+    etas = sorted(args.etas or [args.eta])
+    betas = sorted(args.betas or [args.beta])
+    tasks = []
+    for k in ks:
+        A, fixed = initial_atlas(args, atlas, k, train.index, X)
+        tasks += [(k, eta, A, fixed) for eta in etas]
+    eprint(f'sweeping {len(tasks)} paths of {len(betas)} points, '
+           f'{train.shape[1]} training samples')
+
+    kwargs = dict(n_iter     = args.n_iter,
+                  normalize  = not args.no_norm_weights,
+                  engine     = args.nnls_engine,
+                  solver     = args.solver,
+                  tol        = args.tol,
+                  patience   = args.patience,
+                  warm_start = not args.no_warm_start)
+    initargs = (X, X_fit, X_eval, train_f, test_f, betas, kwargs)
+    threads = min(args.threads, len(tasks))
+    if threads > 1:
+        pool = Pool(threads, _init_sweep, initargs)
+        results = pool.imap_unordered(_run_path, tasks)
+    else:
+        pool = None
+        _init_sweep(*initargs)
+        results = map(_run_path, tasks)
+    rows = [row for path in results for row in path]
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    df = pd.DataFrame(rows).sort_values(['k', 'eta', 'beta'])
+    df = df.reset_index(drop=True)
+    if args.verbose:
+        eprint(df.to_string())
+    df.to_csv(args.prefix + '.sweep.csv', sep=SEP, index=False)
+    eprint(f'dumped {args.prefix}.sweep.csv')
+
+
+def parse_args():
+    parser = build_parser(
+        description='Fit a grid of --beta, --eta and number of unknown '
+                    'columns (--nmf_cols / --add), loading the data once. '
+                    'Writes the objective, sparsity and held-out error of '
+                    'every grid point to <prefix>.sweep.csv')
+    parser.add_argument('--betas', type=float, nargs='+',
+                        help='Values of --beta. Each path is fit in '
+                             'increasing order, each point starting from the '
+                             'atlas of the previous one. Default is --beta')
+    parser.add_argument('--etas', type=float, nargs='+',
+                        help='Values of --eta. Default is --eta')
+    parser.add_argument('--ks', type=int, nargs='+',
+                        help='Numbers of unknown columns (of --nmf_cols, or '
+                             'of --add with --atlas). Default is --nmf_cols '
+                             '/ --add')
+    parser.add_argument('--holdout', type=float, default=DEF_HOLDOUT,
+                        help='Fraction of the samples held out of the fit, '
+                             'and of the features held out when deconvolving '
+                             'them: the held-out error is on those features '
+                             f'of those samples. 0 disables it [{DEF_HOLDOUT}]')
+    args = parser.parse_args()
+    if args.nmf_cols and args.ks and min(args.ks) < 2:
+        eprint('Invalid input: --ks must be >=2 in NMF mode')
+        exit(1)
+    if not 0 <= args.holdout < 1:
+        eprint('Invalid input: --holdout must be in [0, 1)')
+        exit(1)
+    return args
+
+
+if __name__ == '__main__':
+    main()
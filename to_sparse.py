@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+import argparse
+import os.path as op
+from utils_nmf import eprint, load_table, save_npz_table
+
+
+def main():
+    args = parse_args()
+    df = load_table(args.table)
+    outpath = args.outpath
+    if outpath is None:
+        outpath = op.splitext(args.table)[0] + '.npz'
+    save_npz_table(outpath, df)
+    nnz = (df.values != 0).sum()
+    eprint(f'dumped {outpath} ({nnz / df.size:.2%} non zero)')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert an atlas or data table (csv) to the sparse '
+                    'binary format (npz) ssNMF.py reads')
+    parser.add_argument('table', help='Table to convert (csv)')
+    parser.add_argument('--outpath', '-o',
+                        help='output path. Default is the same name as the '
+                             'table, with an npz suffix')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
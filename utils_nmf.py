@@ -2,19 +2,42 @@
 import os
 import sys
 import time
+import json
+import shutil
+import sqlite3
+import tempfile
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import os.path as op
 import argparse
 import subprocess
 import multiprocessing
 from multiprocessing import Pool
 import hashlib
+import importlib.util
 from pathlib import Path
 
+from profiler import profiled
+
 
 dpath = str(Path(op.realpath(__file__)).parent)
 DEF_NR_THREADS = multiprocessing.cpu_count()
 SEP = ','
+DEF_CACHE_DIR = os.environ.get('SSNMF_CACHE_DIR')
+DEF_CACHE_SIZE = 10.0   # GB
+OUT_FORMATS = ('csv', 'npz', 'parquet', 'hdf5')
+DTYPES = ('float64', 'float32')
+FORMAT_EXTS = {'csv': 'csv', 'npz': 'npz', 'parquet': 'parquet', 'hdf5': 'h5'}
+HDF_KEY = 'table'
+# extensions of binary input tables. Other tables are parsed as csv
+BINARY_EXTS = ('.npz', '.parquet', '.h5', '.hdf5')
+# values (rows x samples) per chunk of iter_table, about 80MB as float64
+STREAM_CHUNK = 10 ** 7
+# optional modules required by an output format (any one of them)
+FORMAT_MODULES = {'parquet': ('pyarrow', 'fastparquet'), 'hdf5': ('tables',)}
+CSV_CHUNK = 50000   # rows
+SQL_CHUNK = 500     # keys per sqlite query
 
 #################################
 #                               #
@@ -45,6 +68,26 @@ def pat2name(pat):
     return op.basename(op.splitext(op.splitext(pat)[0])[0])
 
 
+def file_stems(paths):
+    """
+    A name per file, for output files: its path relative to the common
+    parent directory of all paths, without the last extension, with
+    directories joined by dots (e.g. r1/s.N20.csv -> r1.s.N20)
+    """
+    dirs = [op.dirname(op.abspath(p)) for p in paths]
+    parent = op.commonpath(dirs) if paths else ''
+    return [op.splitext(op.relpath(op.abspath(p), parent))[0].replace(op.sep, '.')
+            for p in paths]
+
+
+def missing_format_module(fmt):
+    """ the optional module an output format requires, if not installed """
+    modules = FORMAT_MODULES.get(fmt, ())
+    if modules and not any(importlib.util.find_spec(m) for m in modules):
+        return modules[0]
+    return None
+
+
 def drop_dup_keep_order(lst):
     seen = set()
     return [x for x in lst if not (x in seen or seen.add(x))]
@@ -62,11 +105,97 @@ def mkdir_p(dirpath):
     return dirpath
 
 
-def dump_df(fpath, df, verbose=True):
-    df.to_csv(fpath, float_format='%.5f')
+def file_hash(fpath, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _format_csv_rows(args):
+    """
+    Format rows as df.to_csv(header=False, float_format='%.5f') would,
+    with a single format string (much faster than pandas)
+    """
+    index, values = args
+    if np.isnan(values).any() or \
+            any(c in str(x) for x in index for c in ',"\n'):
+        # empty fields for NaNs, quoted labels: leave to pandas
+        return pd.DataFrame(values, index=index).to_csv(header=False,
+                                                        float_format='%.5f')
+    block = np.empty((values.shape[0], values.shape[1] + 1), dtype=object)
+    block[:, 0] = index
+    block[:, 1:] = values
+    fmt = '%s' + ',%.5f' * values.shape[1] + '\n'
+    return (fmt * values.shape[0]) % tuple(block.ravel())
+
+
+def write_csv(fpath, df, threads=1):
+    """
+    Same as df.to_csv(fpath, float_format='%.5f') for a numeric table,
+    formatted by chunks of rows on threads processes
+    """
+    values = df.values
+    chunks = ((df.index[i:i + CSV_CHUNK], values[i:i + CSV_CHUNK])
+              for i in range(0, df.shape[0], CSV_CHUNK))
+    pool = Pool(threads) if threads > 1 and df.shape[0] > CSV_CHUNK else None
+    with open(fpath, 'w') as f:
+        f.write(df.iloc[:0].to_csv())
+        for text in (map if pool is None else pool.imap)(_format_csv_rows, chunks):
+            f.write(text)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+@profiled('dump_df')
+def dump_df(fpath, df, verbose=True, threads=1):
+    """
+    Save a table. The format is set by the extension of fpath:
+    csv (5 decimal digits), or the lossless npz, parquet or h5 (hdf5)
+    """
+    sparse_df = any(isinstance(t, pd.SparseDtype) for t in df.dtypes)
+    ext = op.splitext(fpath)[1][1:]
+    if ext == 'npz':
+        save_npz_table(fpath, df, sparse_df)
+    else:
+        if sparse_df:
+            df = df.sparse.to_dense()
+        if ext == 'csv':
+            write_csv(fpath, df, threads)
+        else:
+            try:
+                if ext == 'parquet':
+                    df.to_parquet(fpath)
+                else:
+                    df.to_hdf(fpath, key=HDF_KEY, mode='w')
+            except ImportError as e:
+                eprint(f'Error: cannot write {fpath}: {e}')
+                exit(1)
     if verbose:
         eprint(f'dumped {fpath}')
 
+
+def read_table(fpath):
+    """
+    Read a table in any of the output formats (see dump_df) as is,
+    with the first column as index
+    """
+    validate_file(fpath)
+    ext = op.splitext(fpath)[1][1:]
+    try:
+        if ext == 'npz':
+            return load_npz_table(fpath)
+        if ext == 'parquet':
+            return pd.read_parquet(fpath)
+        if ext in ('h5', 'hdf5'):
+            return pd.read_hdf(fpath, HDF_KEY)
+    except ImportError as e:
+        eprint(f'Error: cannot read {fpath}: {e}')
+        exit(1)
+    return pd.read_csv(fpath, sep=SEP, index_col=0)
+
 #################################
 #                               #
 #     NMF Specific logic        #
@@ -74,9 +203,255 @@ def dump_df(fpath, df, verbose=True):
 #################################
 
 
-def load_table(table_path, norm_cols=False):
+def labels_array(labels):
+    """ row/column labels as a numpy array that can be saved without pickle """
+    labels = np.asarray(labels)
+    if labels.dtype == object:
+        labels = labels.astype(str)
+    return labels
+
+
+def table_values(df):
+    """
+    The values of a table (e.g. from load_table), as a scipy.sparse
+    matrix if all its columns are sparse, otherwise as a numpy array
+    """
+    if df.shape[1] and all(isinstance(t, pd.SparseDtype) for t in df.dtypes):
+        return df.sparse.to_coo().tocsc()
+    # single precision tables (see load_table) stay single precision
+    single = df.shape[1] and (df.dtypes == np.float32).all()
+    return df.to_numpy(dtype=np.float32 if single else float)
+
+
+def save_npz_table(fpath, df, sparse_values=True):
+    """
+    Save a table in the binary format (npz) read by load_table: the row
+    and column labels, and either the CSC arrays of the values (sparse),
+    or the values
+    """
+    labels = dict(index=labels_array(df.index),
+                  columns=labels_array(df.columns))
+    if not sparse_values:
+        np.savez(fpath, values=df.values, **labels)
+        return
+    M = sparse.csc_matrix(table_values(df))
+    np.savez(fpath, data=M.data, indices=M.indices, indptr=M.indptr,
+             shape=M.shape, **labels)
+
+
+def load_npz_table(table_path, norm_cols=False, dtype=float):
+    with np.load(table_path) as f:
+        index = pd.Index(f['index'], name='feature')
+        columns = pd.Index(f['columns'])
+        if 'values' in f:
+            df = pd.DataFrame(f['values'].astype(dtype, copy=False),
+                              index=index, columns=columns)
+            return df / df.sum() if norm_cols else df
+        M = sparse.csc_matrix((f['data'].astype(dtype, copy=False),
+                               f['indices'], f['indptr']),
+                              shape=tuple(f['shape']))
+    if norm_cols:
+        M = M @ sparse.diags(1 / np.asarray(M.sum(axis=0)).ravel())
+    return pd.DataFrame.sparse.from_spmatrix(M, index=index, columns=columns)
+
+
+def save_checkpoint(fpath, state, meta):
+    """
+    Save a solver state (see run_deconvolution), the state of the numpy
+    global random generator and a json-able dict meta, to an npz file.
+    The file is replaced atomically, so it is never left half written.
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    tmp = fpath + '.tmp.npz'
+    np.savez(tmp, meta=json.dumps(meta), rng_keys=keys,
+             rng_state=np.array([pos, has_gauss, cached_gaussian]), **state)
+    os.replace(tmp, fpath)
+
+
+def load_checkpoint(fpath):
+    """
+    Load a checkpoint saved by save_checkpoint, and restore the state of
+    the numpy global random generator
+    :return: the solver state, and meta
+    """
+    validate_file(fpath)
+    with np.load(fpath) as f:
+        state = {k: f[k] for k in f.files}
+    pos, has_gauss, cached_gaussian = state.pop('rng_state')
+    np.random.set_state(('MT19937', state.pop('rng_keys'), int(pos),
+                         int(has_gauss), float(cached_gaussian)))
+    meta = json.loads(str(state.pop('meta')))
+    state.update(it=int(state['it']), stalled=int(state['stalled']),
+                 prev_obj=float(state['prev_obj']),
+                 history=list(state['history']))
+    return state, meta
+
+
+class TableCache:
+    """
+    A directory of parsed tables, stored as .npy files and memory-mapped
+    when loaded. Entries are keyed by the table content hash and the load
+    options. The least recently used entries are evicted when the cache
+    grows over max_size GB.
+    """
+    VERSION = 1
+
+    def __init__(self, cache_dir, max_size=DEF_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size * 1024 ** 3)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, table_path, **opts):
+        opts = ','.join(f'{k}={opts[k]}' for k in sorted(opts))
+        opts = hashlib.sha1(f'{self.VERSION};{opts}'.encode()).hexdigest()
+        return f'{file_hash(table_path)}.{opts[:16]}'
+
+    def get(self, key):
+        path = op.join(self.cache_dir, key)
+        if not op.isdir(path):
+            return None
+        os.utime(path)  # mark as recently used
+        with open(op.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        index = pd.Index(np.load(op.join(path, 'index.npy')), name=meta['index_name'])
+        columns = pd.Index(np.load(op.join(path, 'columns.npy')))
+        # the values are saved in Fortran order: samples are contiguous,
+        # and pandas does not need to copy them
+        values = np.load(op.join(path, 'values.npy'), mmap_mode='r')
+        return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+    def put(self, key, df):
+        tmp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            np.save(op.join(tmp, 'values.npy'), np.asfortranarray(df.values))
+            for name, labels in (('index', df.index), ('columns', df.columns)):
+                np.save(op.join(tmp, f'{name}.npy'), labels_array(labels))
+            with open(op.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'index_name': df.index.name}, f)
+            os.rename(tmp, op.join(self.cache_dir, key))
+        except OSError:
+            # e.g. another process cached the same table first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = op.join(self.cache_dir, key)
+            if key.startswith('.') or not op.isdir(path):
+                continue
+            size = sum(op.getsize(op.join(path, f)) for f in os.listdir(path))
+            entries.append((op.getmtime(path), size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+class ResultCache:
+    """
+    A persistent store (sqlite) of per-sample results: the coefficients
+    and the squared error of a sample. Entries are keyed by the hash of
+    the sample values and of a context, which covers everything else the
+    result depends on (the atlas, the parameters). The database is opened
+    lazily, once per process, so the cache can be passed to workers.
+    """
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._db = self._pid = None
+
+    @property
+    def db(self):
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=600)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS results '
+                             '(key TEXT PRIMARY KEY, coef BLOB, sq_error REAL)')
+            self._pid = os.getpid()
+        return self._db
+
+    @classmethod
+    def context(cls, *parts):
+        """ a hash of arrays (incl. scipy.sparse), indices and scalars """
+        h = hashlib.sha1(f'{cls.VERSION}'.encode())
+        for part in parts:
+            if sparse.issparse(part):
+                part = sparse.csc_matrix(part)
+                part = (part.data, part.indices, part.indptr)
+            for p in part if isinstance(part, tuple) else (part,):
+                if isinstance(p, np.ndarray):
+                    h.update(f'{p.dtype}{p.shape}'.encode())
+                    h.update(np.ascontiguousarray(p).tobytes())
+                else:
+                    h.update(repr(list(p) if isinstance(p, pd.Index) else p).encode())
+        return h.digest()
+
+    def keys(self, context, X):
+        """ the key of every sample (column of X) in a context """
+        if sparse.issparse(X):
+            X = sparse.csc_matrix(X)
+            cols = (X.indices[s:e].tobytes() + X.data[s:e].tobytes()
+                    for s, e in zip(X.indptr[:-1], X.indptr[1:]))
+        else:
+            cols = (np.ascontiguousarray(X[:, j]).tobytes()
+                    for j in range(X.shape[1]))
+        return [hashlib.sha1(context + c).hexdigest() for c in cols]
+
+    def get(self, keys):
+        """ {key: (coefficients, squared error)} of the cached keys """
+        found = {}
+        keys = list(set(keys))
+        for i in range(0, len(keys), SQL_CHUNK):
+            chunk = keys[i:i + SQL_CHUNK]
+            rows = self.db.execute('SELECT key, coef, sq_error FROM results '
+                                   f'WHERE key IN ({",".join("?" * len(chunk))})',
+                                   chunk)
+            found.update((k, (np.frombuffer(c), e)) for k, c, e in rows)
+        return found
+
+    def put(self, keys, Y, sq_errors):
+        """ cache the coefficients (columns of Y) and errors of keys """
+        Y = np.asarray(Y, dtype=float)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                ((k, Y[:, j].tobytes(), float(e)) for j, (k, e)
+                                 in enumerate(zip(keys, sq_errors))))
+
+
+@profiled('load_table')
+def load_table(table_path, norm_cols=False, cache=None, dtype=float):
+    """
+    Load a table - a csv file, or a binary table (npz, see save_npz_table,
+    parquet or hdf5) - with the features as index.
+    The values are parsed as dtype (float64 or float32).
+    """
     validate_file(table_path)
-    df = pd.read_csv(table_path, sep=SEP, index_col=None)
+    ext = op.splitext(table_path)[1]
+    if ext in BINARY_EXTS:
+        if ext == '.npz':
+            df = load_npz_table(table_path, norm_cols, dtype)
+        else:
+            df = read_table(table_path).astype(dtype)
+            df = df / df.sum() if norm_cols else df
+        if df.shape[1] < 2:
+            eprint(f'Invalid table: {table_path}. Too few columns ({df.shape[1] + 1})')
+            exit(1)
+        df.index.name = 'feature'
+        return df
+    if cache is not None:
+        key = cache.key(table_path, norm_cols=norm_cols,
+                        dtype=np.dtype(dtype).name)
+        df = cache.get(key)
+        if df is not None:
+            return df
+    # parse the values directly as dtype (the first column is the index)
+    header = pd.read_csv(table_path, sep=SEP, nrows=0).columns
+    df = pd.read_csv(table_path, sep=SEP, index_col=None,
+                     dtype={c: dtype for c in header[1:]})
     if df.shape[1] < 3:
         eprint(f'Invalid table: {table_path}. Too few columns ({df.shape[1]})')
         exit(1)
@@ -84,9 +459,29 @@ def load_table(table_path, norm_cols=False):
     df.set_index('feature', inplace=True)
     if norm_cols:
         df = df.apply(lambda x: x / x.sum())
+    if cache is not None:
+        cache.put(key, df)
     return df
 
 
+def iter_table(table_path, chunk_size=STREAM_CHUNK):
+    """
+    Iterate over a csv table (same format as load_table) in chunks of
+    about chunk_size values, without loading it to memory. The number of
+    rows per chunk is set by the number of columns, so memory is bounded
+    for wide tables too.
+    """
+    validate_file(table_path)
+    nr_cols = len(pd.read_csv(table_path, sep=SEP, nrows=0).columns)
+    for df in pd.read_csv(table_path, sep=SEP, index_col=0,
+                          chunksize=max(chunk_size // nr_cols, 1)):
+        if df.shape[1] < 2:
+            eprint(f'Invalid table: {table_path}. Too few columns ({df.shape[1] + 1})')
+            exit(1)
+        df.index.name = 'feature'
+        yield df
+
+
 def parse_cut_str(cstr, maxlen):
     """
     Parse user input forr columns choice with unix cut syntax